@@ -1,42 +1,166 @@
 from __future__ import absolute_import
 
 import os
-import requests
+import re
 import time
 import json
 import locale
-from kindle_logging import log, LIBRARIAN_SYNC
+import threading
+from collections import OrderedDict
+from six.moves import queue
+from kindle_logging import log, progress, LIBRARIAN_SYNC, PROGRESS_INTERVAL
+from profiling import PROFILER, phase, count
+
+CC_CHANGE_URL = "http://127.0.0.1:9101/change"
+PRETTYVERSION_FILE = u"/etc/prettyversion.txt"
+SESSION_TOKEN_FILE = "/tmp/session_token"
+
+# Commands are sent in batches, whose size adapts to how long the service
+# takes to acknowledge them: grow while it answers quickly, shrink when it
+# starts to struggle.
+BATCH_SIZE = 500
+MIN_BATCH_SIZE = 50
+MAX_BATCH_SIZE = 5000
+TARGET_BATCH_LATENCY = 2.0
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+# (connect, read): a stuck service counts as a failed attempt, rather than
+# keep us waiting forever (batches that slow get smaller anyway)
+TIMEOUT = (3, 60)
+# Commands are saved there before being sent, along with a checkpoint line
+# per acknowledged batch, so that an interrupted run can be resumed
+# (relative to the extension folder).
+JOURNAL = u"cc_update_journal.json"
+JOURNAL_VERSION = 2
+
+
+# The firmware doesn't change while we run, only check it once
+CC_AWARE = None
 
 
 def is_cc_aware():
+    global CC_AWARE
+    if CC_AWARE is not None:
+        return CC_AWARE
+
     # Check if the device is CloudCollections aware in order to know
     # which fields to pass...
-    with open(u"/etc/prettyversion.txt", "r") as f:
+    with open(PRETTYVERSION_FILE, "r") as f:
         prettyversion = f.read()
 
     # We just want the human readable version string, not the crap around it
     parsed_version = prettyversion.split(" ")
     fw_version = parsed_version[1]
 
-    # Don't reinvent the wheel
-    from distutils.version import LooseVersion
-    if LooseVersion(fw_version) >= LooseVersion('5.4.2'):
-        return True
-    else:
-        return False
+    # NOTE: Not using distutils' LooseVersion, it's slow to import,
+    # and gone from recent Pythons. Comparing the numbers is enough here.
+    CC_AWARE = tuple(int(n) for n in re.findall(r"\d+", fw_version)) >= \
+        (5, 4, 2)
+    return CC_AWARE
 
 def get_session_token():
     try:
-        with open("/tmp/session_token", "r") as f:
+        with open(SESSION_TOKEN_FILE, "r") as f:
             return f.read()
     except:
         return ""
 
 class CCUpdate(object):
-    def __init__(self):
+    """Queues commands, and sends them to the content catalog service.
+    Commands can be released as they're computed (see release()), they're
+    then sent in the background, while the next ones are being computed."""
+    def __init__(self, batch_size=BATCH_SIZE, min_batch_size=MIN_BATCH_SIZE,
+                 max_batch_size=MAX_BATCH_SIZE,
+                 target_latency=TARGET_BATCH_LATENCY, max_retries=MAX_RETRIES,
+                 timeout=TIMEOUT, journal=None):
+        # commands not released yet
         self.commands = []
+        # journaled runs keep their journal until everything's been sent
+        self.journal = journal
+        self.journal_file = None
+        self.journal_lock = threading.Lock()
+        # resumed runs send what was left, as it was planned
+        self.resumed = False
+        self.first_batch_id = 1
         self.is_cc_aware = is_cc_aware()
         self.session_token = get_session_token()
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.timeout = timeout
+        # sender thread, fed lists of released commands (None when done)
+        self.sender = None
+        self.queue = queue.Queue()
+        self.released = 0
+        self.sent = 0
+        self.failed = False
+        # only known once everything's been released
+        self.total = None
+
+    @classmethod
+    def from_journal(cls, journal=JOURNAL):
+        """The commands an interrupted run didn't get acknowledged, or None
+        if there's nothing to resume."""
+        commands = []
+        sent = 0
+        batch_id = 1
+        complete = False
+        try:
+            with open(journal, "r") as f:
+                header = json.loads(f.readline())
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # cut short while being written
+                        break
+                    if "commands" in entry:
+                        commands.extend(entry["commands"])
+                    elif "sent" in entry:
+                        sent = entry["sent"]
+                        batch_id = entry["batch"] + 1
+                    elif "complete" in entry:
+                        complete = True
+        except (IOError, OSError, ValueError):
+            header = {}
+        if header.get("version") != JOURNAL_VERSION or \
+           sent >= len(commands):
+            log(LIBRARIAN_SYNC, "cc_update", "Nothing to resume.")
+            return None
+        if not complete:
+            # it'd only do part of the job
+            log(LIBRARIAN_SYNC, "cc_update",
+                "The interrupted run stopped before it was done working out "
+                "what to change, run it again instead.", "W")
+            return None
+        cc = cls(journal=journal)
+        cc.commands = commands[sent:]
+        cc.resumed = True
+        cc.first_batch_id = batch_id
+        log(LIBRARIAN_SYNC, "cc_update",
+            "Resuming from batch %d: %d out of %d commands left."
+            % (batch_id, len(cc.commands), len(commands)),
+            display=False)
+        return cc
+
+    def write_journal(self, entry):
+        with self.journal_lock:
+            if self.journal_file is None:
+                self.journal_file = open(self.journal, "w")
+                self.journal_file.write(json.dumps(
+                    {"version": JOURNAL_VERSION,
+                     "created": int(time.time())}) + "\n")
+            self.journal_file.write(json.dumps(entry) + "\n")
+            self.journal_file.flush()
+            os.fsync(self.journal_file.fileno())
+
+    def remove_journal(self):
+        try:
+            os.remove(self.journal)
+        except OSError:
+            pass
 
     def delete_collection(self, coll_uuid):
         self.commands.append(
@@ -103,23 +227,228 @@ class CCUpdate(object):
                         }
                 })
 
-    def execute(self):
-        if not self.commands:
-            log(LIBRARIAN_SYNC, "cc_update", "Nothing to update.")
-        else:
-            log(LIBRARIAN_SYNC, "cc_update", "Sending commands...")
-            full_command = {"commands": self.commands,
-                            "type": "ChangeRequest", "id": 1}
-            # When WiFi's enabled, we inherit the WhisperSync proxy, which we *cannot* go through,
-            # since we're talking to a local service. So make sure we do *NOT* use any proxies.
-            # Turns out that this is *slightly* tricky to achieve with requests,
-            # c.f., https://github.com/requests/requests/issues/879#issuecomment-10001977
-            os.environ['no_proxy'] = '127.0.0.1,localhost'
-            r = requests.post("http://127.0.0.1:9101/change",
-                              data=json.dumps(full_command),
-                              headers={'AuthToken': self.session_token, 'content-type': 'application/json'},
-                              proxies={'no': 'pass'})
+    def optimize(self):
+        """Coalesce commands before sending them: only keep the last update
+        of a given entry, drop the ones that wouldn't change anything, and
+        send them in an order that's easy on the service.
+        NOTE: it only sees the commands released together (see release())."""
+        deletes = OrderedDict()
+        inserts = OrderedDict()
+        collection_updates = {}
+        ebook_updates = {}
+        merged = noops = 0
+        for command in self.commands:
+            (action, details), = command.items()
+            entry_uuid = str(details["uuid"])
+            if action == "delete":
+                if collection_updates.pop(entry_uuid, None) is not None:
+                    noops += 1
+                if entry_uuid in deletes:
+                    merged += 1
+                deletes[entry_uuid] = command
+            elif action == "insert":
+                inserts[entry_uuid] = command
+            elif details["type"] == "Collection":
+                if entry_uuid in deletes:
+                    noops += 1
+                    continue
+                if entry_uuid in collection_updates:
+                    merged += 1
+                collection_updates[entry_uuid] = command
+            else:
+                if entry_uuid in ebook_updates:
+                    merged += 1
+                ebook_updates[entry_uuid] = command
+
+        # deletions before insertions, memberships once collections exist,
+        # and updates in uuid order, which is also cc.db's index order
+        commands = list(deletes.values()) + list(inserts.values())
+        commands.extend(collection_updates[entry_uuid]
+                        for entry_uuid in sorted(collection_updates))
+        commands.extend(ebook_updates[entry_uuid]
+                        for entry_uuid in sorted(ebook_updates))
+        removed = len(self.commands) - len(commands)
+        count("commands removed", removed)
+        if removed:
+            log(LIBRARIAN_SYNC, "cc_update",
+                "Optimized away %d out of %d commands (%d merged, %d no-ops)."
+                % (removed, len(self.commands), merged, noops),
+                display=False)
+        self.commands = commands
+
+    def post_batch(self, session, batch_id, commands):
+        import requests
+        full_command = {"commands": commands,
+                        "type": "ChangeRequest", "id": batch_id}
+        with phase("serialize"):
+            data = json.dumps(full_command)
+        count("payload bytes", len(data))
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+                log(LIBRARIAN_SYNC, "cc_update",
+                    "Retrying batch %d (attempt %d)..." % (batch_id, attempt),
+                    "W", display=False)
+            count("requests")
+            try:
+                with phase("post"):
+                    r = session.post(CC_CHANGE_URL,
+                                     data=data,
+                                     headers={'AuthToken': self.session_token,
+                                              'content-type':
+                                                  'application/json'},
+                                     proxies={'no': 'pass'},
+                                     timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                log(LIBRARIAN_SYNC, "cc_update",
+                    "Batch %d: %s" % (batch_id, e), "W", display=False)
+                continue
             if r.status_code == requests.codes.ok:
-                log(LIBRARIAN_SYNC, "cc_update", "Success.")
+                return True
+            log(LIBRARIAN_SYNC, "cc_update",
+                "Batch %d: HTTP %d" % (batch_id, r.status_code), "W",
+                display=False)
+        return False
+
+    def release(self, at_least=1):
+        """Hand the commands queued so far over to the sender thread (if
+        there are at least that many). They're sent in order, and before
+        anything released later."""
+        if len(self.commands) < max(at_least, 1):
+            return
+        if not self.resumed:
+            with phase("optimize"):
+                self.optimize()
+        commands, self.commands = self.commands, []
+        if not commands:
+            return
+        if PROFILER.enabled:
+            for command in commands:
+                for (action, details) in command.items():
+                    count(" ".join(["commands:", action] +
+                                   ([details["type"]]
+                                    if "type" in details else [])))
+        if self.journal is not None:
+            with phase("journal"):
+                self.write_journal({"commands": commands})
+        if self.sender is None:
+            self.start()
+        self.released += len(commands)
+        self.queue.put(commands)
+
+    def start(self):
+        log(LIBRARIAN_SYNC, "cc_update", "Sending commands...")
+        # requests is slow to import, only do it when there's work to do
+        # (and not from the sender thread, Python 2 imports don't like that)
+        import requests
+        # When WiFi's enabled, we inherit the WhisperSync proxy, which we *cannot* go through,
+        # since we're talking to a local service. So make sure we do *NOT* use any proxies.
+        # Turns out that this is *slightly* tricky to achieve with requests,
+        # c.f., https://github.com/requests/requests/issues/879#issuecomment-10001977
+        os.environ['no_proxy'] = '127.0.0.1,localhost'
+        # Keep the connection alive between batches
+        self.sender = threading.Thread(target=self._send, name="sender",
+                                       args=(requests.Session(),))
+        # don't keep the process alive if the main thread gave up
+        self.sender.daemon = True
+        self.sender.start()
+
+    def _next_batch(self, pending, batch_size, done):
+        """Wait for something to send, then take whatever's been released
+        since, up to a full batch."""
+        while not done:
+            try:
+                commands = self.queue.get(block=not pending)
+            except queue.Empty:
+                break
+            if commands is None:
+                done = True
             else:
-                log(LIBRARIAN_SYNC, "cc_update", "Oh, no. It failed.", "E")
+                pending.extend(commands)
+                if len(pending) >= batch_size:
+                    break
+        batch = pending[:batch_size]
+        del pending[:batch_size]
+        return batch, done
+
+    def _send(self, session):
+        # NOTE: only logs to syslog, the screen is the main thread's (see
+        # execute())
+        batch_size = self.batch_size
+        batch_id = self.first_batch_id
+        pending = []
+        done = False
+        try:
+            while True:
+                batch, done = self._next_batch(pending, batch_size, done)
+                if not batch:
+                    break
+                batch_start = time.time()
+                if not self.post_batch(session, batch_id, batch):
+                    self.failed = True
+                    break
+                latency = time.time() - batch_start
+                self.sent += len(batch)
+                if self.journal is not None:
+                    self.write_journal({"sent": self.sent, "batch": batch_id})
+                log(LIBRARIAN_SYNC, "cc_update",
+                    "Batch %d: %d commands in %.02fs (%d/%s)."
+                    % (batch_id, len(batch), latency, self.sent,
+                       self.total or "%d+" % self.released),
+                    display=False)
+                if latency > self.target_latency:
+                    batch_size = max(self.min_batch_size, batch_size // 2)
+                elif latency < self.target_latency / 2:
+                    batch_size = min(self.max_batch_size, batch_size * 2)
+                batch_id += 1
+        except Exception as e:
+            log(LIBRARIAN_SYNC, "cc_update", "Sender: %s" % e, "E",
+                display=False)
+            self.failed = True
+        finally:
+            session.close()
+
+    def abort(self):
+        """Stop sending (what's been released and not sent yet is dropped)"""
+        if self.sender is not None:
+            self.failed = True
+            self.queue.put(None)
+            self.sender.join()
+        if self.journal_file is not None:
+            self.journal_file.close()
+
+    def execute(self):
+        """Release what's left, and wait until everything has been sent"""
+        self.release()
+        if self.sender is None:
+            if self.journal is not None:
+                # whatever an earlier run left undone doesn't matter anymore
+                self.remove_journal()
+            log(LIBRARIAN_SYNC, "cc_update", "Nothing to update.")
+            return True
+
+        self.total = self.released
+        if self.journal is not None:
+            self.write_journal({"complete": True})
+        self.queue.put(None)
+        # NOTE: a timeout, so that the main thread still gets signals, and
+        # shows how far the sender got in the meantime
+        while self.sender.is_alive():
+            self.sender.join(PROGRESS_INTERVAL)
+            progress(LIBRARIAN_SYNC, "Sending", self.sent, self.total)
+        if self.journal_file is not None:
+            self.journal_file.close()
+        if self.failed or self.sent < self.total:
+            log(LIBRARIAN_SYNC, "cc_update",
+                "Oh, no. It failed (%d/%d commands sent)."
+                % (self.sent, self.total), "E")
+            if self.journal is not None:
+                log(LIBRARIAN_SYNC, "cc_update",
+                    "Use 'Resume interrupted sync' (--resume) to "
+                    "send the rest.", "W")
+            return False
+        progress(LIBRARIAN_SYNC, "Sending", self.sent, self.total)
+        if self.journal is not None:
+            self.remove_journal()
+        log(LIBRARIAN_SYNC, "cc_update", "Success.")
+        return True
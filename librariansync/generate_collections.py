@@ -3,22 +3,32 @@
 
 from __future__ import absolute_import
 
+import io
 import json
 import os
 import uuid
 import sys
 import codecs
+import filecmp
+import locale
 import re
 import time
 import traceback
 import argparse
+import signal
 import sqlite3
-from collections import defaultdict
+import struct
+import threading
+import six
+from six.moves import cPickle as pickle
 
-from cc_update import CCUpdate
-from kindle_contents import Ebook, Collection
-from kindle_contents import find_collection, find_ebook, list_folder_contents
-from kindle_logging import log, LIBRARIAN_SYNC
+from cc_update import CCUpdate, JOURNAL
+from kindle_contents import Ebook, Collection, Catalog, RegexMatcher
+from kindle_contents import list_folder_contents, get_relative_path
+from kindle_contents import SUPPORTED_EXTENSIONS
+from kindle_logging import log, log_aggregated, flush_aggregated, progress
+from kindle_logging import set_headless, LIBRARIAN_SYNC
+from profiling import PROFILER, PROFILE_REPORT, phase, count
 
 # -------- Config
 KINDLE_DB_PATH = u"/var/local/cc.db"
@@ -26,108 +36,417 @@ TAGS = u"../collections.json"
 CALIBRE_PLUGIN_FILE = u"/mnt/us/system/collections.json"
 EXPORT = u"../exported_collections.json"
 KINDLE_EBOOKS_ROOT = u"/mnt/us/documents/"
+# where SQLite writes first, depending on its journal mode
+CC_DB_SUFFIXES = [u"", u"-journal", u"-wal"]
+# parse_entries' results, for as long as cc.db doesn't change
+CATALOG_CACHE = u"cc_db_cache.pickle"
+CATALOG_CACHE_VERSION = 1
 
 SELECT_COLLECTION_ENTRIES = u'select p_uuid, p_titles_0_nominal '\
                             u'from Entries where p_type = "Collection"'
-SELECT_EBOOK_ENTRIES = u'select p_uuid, p_location, p_cdeKey, p_cdeType '\
-                       u'from Entries where p_type = "Entry:Item"'
+# only consider user ebooks (GLOB is case sensitive, and can use an index)
+# (p_collectionCount only exists on CloudCollections aware firmwares)
+SELECT_EBOOK_ENTRIES = u'select p_uuid, p_location, p_cdeKey, p_cdeType, %s '\
+                       u'from Entries where p_type = "Entry:Item" '\
+                       u'and p_location glob ?'
+# only (collection, user ebook) couples that actually exist
+# NOTE: the subqueries are only run once, into a temporary index, which is
+# cheaper than looking both uuids up in Entries for each row
 SELECT_EXISTING_COLLECTIONS = u'select i_collection_uuid, i_member_uuid '\
-                              u'from Collections'
+                              u'from Collections '\
+                              u'where i_collection_uuid in '\
+                              u'(select p_uuid from Entries '\
+                              u'where p_type = "Collection") '\
+                              u'and i_member_uuid in '\
+                              u'(select p_uuid from Entries '\
+                              u'where p_type = "Entry:Item" '\
+                              u'and p_location glob ?)'
+COUNT_COLLECTIONS = u'select count(*) from Collections'
+# what a sync depends on in cc.db (user ebooks, collections & their members),
+# cheaply: rows added, removed or moved show up there
+CC_DB_FINGERPRINT = u'select count(*), max(rowid), total(length(p_location)) '\
+                    u'from Entries where p_type = "Entry:Item" '\
+                    u'and p_location glob ? '\
+                    u'union all '\
+                    u'select count(*), max(rowid), 0 from Entries '\
+                    u'where p_type = "Collection" '\
+                    u'union all '\
+                    u'select count(*), max(rowid), total(rowid) '\
+                    u'from Collections'
+SELECT_EXISTING_UUIDS = u'select p_uuid from Entries where p_uuid in (%s)'
+# SQLITE_MAX_VARIABLE_NUMBER, on older builds
+SQLITE_MAX_VARIABLES = 999
+# legacy calibre plugin hash: md5 of the full path
+LEGACY_PATH_HASH = re.compile(u"^[0-9a-fA-F]{32}$")
+# how often (in entries) long loops update the progress display
+PROGRESS_STEP = 256
+# 64MB, which is plenty for the whole cc.db on most devices
+CC_DB_MMAP_SIZE = 64 * 1024 * 1024
+# cc.db rows are fetched that many at a time
+FETCH_SIZE = 1024
+# if set (see --max-memory), give up reading cc.db rather than use more than
+# that much memory (in bytes), instead of making a low-RAM device swap
+MAX_MEMORY = None
+# if set (see --full-scan), list every folder again, rather than only the
+# ones that changed since the last scan
+FULL_SCAN = False
+# json collections files are read (and matched) that much at a time
+JSON_CHUNK_SIZE = 64 * 1024
+JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+JSON_COLON = re.compile(r'[ \t\n\r]*(:)[ \t\n\r]*')
+JSON_COMMA_OR_END = re.compile(r'[ \t\n\r]*([,}])[ \t\n\r]*')
+JSON_NUMBER_CHARS = u"0123456789.eE+-"
 
 
 # -------- Existing Kindle database entries
+def open_cc_db(db_path=None):
+    if db_path is None:
+        db_path = KINDLE_DB_PATH
+    # We never write to cc.db directly (that's what CCUpdate is for), so open
+    # it read-only, to stay out of the way of the ccat service's locks.
+    try:
+        cc_db = sqlite3.connect(u"file:%s?mode=ro" % db_path, uri=True)
+    except TypeError:
+        # Python 2's sqlite3 doesn't do URIs
+        cc_db = sqlite3.connect(db_path)
+    cc_db.execute(u"pragma query_only = 1")
+    if MAX_MEMORY is None:
+        cc_db.execute(u"pragma mmap_size = %d" % CC_DB_MMAP_SIZE)
+    else:
+        # mapped pages count as ours, only go through SQLite's (bounded)
+        # page cache
+        cc_db.execute(u"pragma mmap_size = 0")
+    return cc_db
+
+
+def resident_memory():
+    try:
+        with open(u"/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def fetch_rows(cursor):
+    """Yields the rows of the last query, FETCH_SIZE at a time, while
+    checking we're still under MAX_MEMORY."""
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            return
+        if MAX_MEMORY is not None:
+            used = resident_memory()
+            if used is not None and used > MAX_MEMORY:
+                raise MemoryError("using %dMB, over the %dMB limit"
+                                  % (used // 1048576, MAX_MEMORY // 1048576))
+        for row in rows:
+            yield row
+
+
+def has_column(cursor, table, column):
+    cursor.execute(u"pragma table_info(%s)" % table)
+    return any(row[1] == column for row in cursor)
+
+
 def parse_entries(cursor, ignore_empty_collections=False):
-    db_ebooks = []
-    db_collections = []
+    catalog = Catalog()
+    root_glob = KINDLE_EBOOKS_ROOT + u"*"
 
     cursor.execute(SELECT_COLLECTION_ENTRIES)
-    for (c_uuid, label) in cursor.fetchall():
-        db_collections.append(Collection(c_uuid, label))
-
-    cursor.execute(SELECT_EBOOK_ENTRIES)
-    for (e_uuid, location, cdekey, cdetype) in cursor.fetchall():
-        # only consider user ebooks
-        if location is not None and KINDLE_EBOOKS_ROOT in location:
-            db_ebooks.append(Ebook(e_uuid, location, cdekey, cdetype))
-
-    cursor.execute(SELECT_EXISTING_COLLECTIONS)
-    for (collection_uuid, ebook_uuid) in cursor.fetchall():
-        collection_idx = find_collection(db_collections, collection_uuid)
-        ebook_idx_list = find_ebook(db_ebooks, ebook_uuid)
-        if collection_idx != -1 and ebook_idx_list != []:
-            for ebook_idx in ebook_idx_list:
-                db_collections[collection_idx].add_ebook(db_ebooks[ebook_idx],
-                                                        True)
-                db_ebooks[ebook_idx].add_collection(
-                    db_collections[collection_idx], True)
-        else:
-            log(LIBRARIAN_SYNC, "parse_entries",
-                "Skipping collection {} (collection_idx: {}, ebook_uuid: {})"
-                .format(collection_uuid, collection_idx, ebook_uuid),
-                "W", display=False)
+    for (c_uuid, label) in fetch_rows(cursor):
+        catalog.add_collection(Collection(c_uuid, label))
+
+    cursor.execute(SELECT_EBOOK_ENTRIES
+                   % (u"p_collectionCount"
+                      if has_column(cursor, u"Entries", u"p_collectionCount")
+                      else u"null"), (root_glob,))
+    for (e_uuid, location, cdekey, cdetype, collection_count) in \
+            fetch_rows(cursor):
+        catalog.add_ebook(Ebook(e_uuid, location, cdekey, cdetype,
+                                collection_count))
+
+    cursor.execute(SELECT_EXISTING_COLLECTIONS, (root_glob,))
+    valid_entries = 0
+    for (collection_uuid, ebook_uuid) in fetch_rows(cursor):
+        collection = catalog.find_collection(collection_uuid)
+        for ebook in catalog.find_ebooks(ebook_uuid):
+            collection.add_ebook(ebook, True)
+            ebook.add_collection(collection, True)
+        valid_entries += 1
+
+    cursor.execute(COUNT_COLLECTIONS)
+    skipped_entries = cursor.fetchone()[0] - valid_entries
+    count("collections read", len(catalog.collections))
+    count("ebooks read", len(catalog.ebooks))
+    count("memberships read", valid_entries)
+    count("memberships skipped", skipped_entries)
+    if skipped_entries:
+        log(LIBRARIAN_SYNC, "parse_entries",
+            "Skipped %d collection entries (unknown collection, or not a "
+            "user ebook)" % skipped_entries, "W", display=False)
 
     # remove empty collections:
     if ignore_empty_collections:
-        db_collections = [c for c in db_collections
-                          if len(c.original_ebooks) != 0]
+        catalog.remove_empty_collections(original=True)
+
+    return catalog
+
 
-    return db_ebooks, db_collections
+def cc_db_state():
+    """What cc.db looks like from the outside: as long as that's the same,
+    so are its contents."""
+    state = [CATALOG_CACHE_VERSION, KINDLE_DB_PATH, KINDLE_EBOOKS_ROOT]
+    for suffix in CC_DB_SUFFIXES:
+        try:
+            st = os.stat(KINDLE_DB_PATH + suffix)
+            state.append((st.st_dev, st.st_ino, st.st_size, st.st_mtime))
+        except OSError:
+            state.append(None)
+    # NOTE: data_version only means something within a connection, but the
+    # header's file change counter is bumped by every commit (outside of WAL
+    # mode, where the -wal file grows instead)
+    try:
+        with open(KINDLE_DB_PATH, "rb") as f:
+            f.seek(24)
+            state.append(struct.unpack(">I", f.read(4))[0])
+    except (IOError, OSError, struct.error):
+        state.append(None)
+    return state
+
+
+def load_catalog(cursor):
+    """parse_entries, or what it returned last time, if cc.db didn't change
+    since (and we didn't send it anything in the meantime).
+    Returns the catalog, and what save_catalog needs to save it (None if
+    it's already saved): the catalog changes once matched, but the original
+    state of what it had read doesn't, until commands are sent."""
+    # it all has to fit in memory at once
+    if MAX_MEMORY is not None:
+        return parse_entries(cursor), None
+    # before reading cc.db: if it changes while we do, we'll read it again
+    state = cc_db_state()
+    catalog = None
+    try:
+        with open(CATALOG_CACHE, "rb") as f:
+            if pickle.load(f) == state:
+                catalog = Catalog.load(f)
+    except (IOError, OSError):
+        pass
+    except Exception as e:
+        log(LIBRARIAN_SYNC, "load_catalog",
+            "Ignoring unreadable cache (%s)" % e, "W", display=False)
+    if catalog is None:
+        catalog = parse_entries(cursor)
+        return catalog, (state, list(catalog.collections))
+    count("catalog cache hits")
+    log(LIBRARIAN_SYNC, "load_catalog", "cc.db didn't change, using cache.",
+        display=False)
+    return catalog, None
+
+
+def save_catalog(catalog, cache_state):
+    """Save what load_catalog read from cc.db, for next time (there's no
+    point if we then sent it anything)."""
+    if cache_state is None:
+        return
+    state, collections = cache_state
+    with phase("save cache"):
+        tmp_file = CATALOG_CACHE + u".tmp"
+        try:
+            with open(tmp_file, "wb") as f:
+                pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+                catalog.dump(f, collections)
+            os.rename(tmp_file, CATALOG_CACHE)
+        except (IOError, OSError) as e:
+            log(LIBRARIAN_SYNC, "save_catalog",
+                "Couldn't save cache (%s)" % e, "W", display=False)
+
+
+def invalidate_catalog_cache():
+    # cc.db's mtime might not show our changes right away
+    try:
+        os.remove(CATALOG_CACHE)
+    except OSError:
+        pass
 
 
 # -------- JSON collections
+class JSONObjectReader(object):
+    """Yields the (key, value) pairs of the top-level object of a json file,
+    while reading it, one chunk at a time.
+
+    Only the current chunk and value are ever in memory."""
+    def __init__(self, config_file, chunk_size=JSON_CHUNK_SIZE,
+                 msg="Matching"):
+        self.config_file = config_file
+        self.chunk_size = chunk_size
+        self.msg = msg
+        self.decoder = json.JSONDecoder()
+
+    def _read_more(self, size):
+        chunk = self.f.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        # drop what was already decoded
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        self.read += len(chunk)
+        progress(LIBRARIAN_SYNC, self.msg, min(self.read, self.size),
+                 self.size)
+        return True
+
+    def _peek(self):
+        while True:
+            self.pos = JSON_WHITESPACE.match(self.buf, self.pos).end()
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._read_more(self.chunk_size):
+                raise ValueError("%s: unexpected end of file"
+                                 % self.config_file)
+
+    def _expect(self, expected):
+        char = self._peek()
+        if char not in expected:
+            raise ValueError("%s: expected %s, got %r"
+                             % (self.config_file, expected, char))
+        self.pos += 1
+        return char
+
+    def _separator(self, pattern, expected):
+        # fast path: the whole separator is in the buffer
+        match = pattern.match(self.buf, self.pos)
+        if match is not None and match.end() < len(self.buf):
+            self.pos = match.end()
+            return match.group(1)
+        return self._expect(expected)
+
+    def _decode(self):
+        if self.pos >= len(self.buf) or self.buf[self.pos] in u" \t\n\r":
+            self._peek()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number could have been cut at the end of the chunk
+                if self.eof or (end < len(self.buf) and
+                                self.buf[end] not in JSON_NUMBER_CHARS):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            # incomplete value, read (a growing amount) more
+            self._read_more(size)
+            size *= 2
+
+    def __iter__(self):
+        with io.open(self.config_file, 'r', encoding='utf-8') as f:
+            self.f = f
+            self.buf = u""
+            self.pos = self.read = 0
+            self.eof = False
+            self.size = os.fstat(self.f.fileno()).st_size
+            self._expect(u"{")
+            if self._peek() == u"}":
+                return
+            while True:
+                key = self._decode()
+                self._separator(JSON_COLON, u":")
+                yield key, self._decode()
+                if self._separator(JSON_COMMA_OR_END, u",}") == u"}":
+                    break
+            progress(LIBRARIAN_SYNC, self.msg, self.size, self.size)
+
+
 def parse_config(config_file):
-    return json.load(open(config_file, 'r'))
+    # (ebook_location, [collection_label, ...]), streamed
+    return JSONObjectReader(config_file)
+
+
+# handle the locale properly (RegEx borrowed from the KCP)
+COLL_NAME_PATTERN = re.compile(r'^(.*)@[^@]+$')
 
 
 def parse_calibre_plugin_config(config_file):
-    calibre_plugin_config = json.load(open(config_file, 'r'))
-    # handle the locale properly (RegEx borrowed from the KCP)
-    coll_name_pattern = re.compile(r'^(.*)@[^@]+$')
-    # collection_label: [ebook_uuid, ...]
-    collection_members_uuid = defaultdict(list)
-    for collection in calibre_plugin_config.keys():
-        collection_members_uuid[
-            coll_name_pattern.sub(r'\1', collection)
-            ].extend(calibre_plugin_config[collection]["items"])
-    return collection_members_uuid
-
-
-def update_lists_from_librarian_json(db_ebooks, db_collections,
-                                     collection_contents):
-
-    for (ebook_location,
-         ebook_collection_labels_list) in collection_contents.items():
-        # find ebook by location
+    # (collection_label, [ebook_hash, ...]), streamed
+    # NOTE: the same label in different locales is the same collection,
+    # they're merged when matching.
+    for (collection, contents) in JSONObjectReader(config_file):
+        yield COLL_NAME_PATTERN.sub(r'\1', collection), contents["items"]
+
+
+def find_or_create_collection(catalog, collection_label):
+    # find collection by label
+    collection = catalog.find_collection(collection_label)
+    if collection is None:
+        # creating new collection object
+        collection = Collection(uuid.uuid4(), collection_label, is_new=True)
+        catalog.add_collection(collection)
+    return collection
+
+
+def update_librarian_entry(catalog, ebooks, ebook_collection_labels_list):
+    for collection_label in ebook_collection_labels_list:
+        collection = find_or_create_collection(catalog, collection_label)
+        for ebook in ebooks:
+            # udpate ebook
+            ebook.add_collection(collection)
+            # update collection
+            collection.add_ebook(ebook)
+
+
+def update_lists_from_librarian_json(catalog, collection_contents):
+    # collection_contents is either a dict, or a stream of its items
+    if isinstance(collection_contents, dict):
+        total = len(collection_contents)
+        collection_contents = collection_contents.items()
+    else:
+        # the stream shows its own progress
+        total = None
+
+    matched = unmatched = 0
+    # regexps are kept for later, to match them all at once
+    regexp_entries = []
+    for (i, (ebook_location, ebook_collection_labels_list)) in \
+            enumerate(collection_contents):
+        if total is not None and i % PROGRESS_STEP == 0:
+            progress(LIBRARIAN_SYNC, "Matching", i, total)
         if ebook_location.startswith("re:"):
-            ebook_idx_list = find_ebook(db_ebooks, ebook_location, regexp=True)
-        else:
-            ebook_idx_list = find_ebook(db_ebooks, os.path.join(
-                KINDLE_EBOOKS_ROOT, ebook_location))
-        if ebook_idx_list == []:
-            log(LIBRARIAN_SYNC, "update librarian",
-                "Invalid location: %s" % ebook_location.encode("utf8"),
-                "W", display=False)
+            regexp_entries.append((ebook_location,
+                                   ebook_collection_labels_list))
+            continue
+        # find ebook by location
+        ebooks = catalog.find_ebooks(os.path.join(KINDLE_EBOOKS_ROOT,
+                                                  ebook_location))
+        if ebooks == []:
+            log_aggregated(LIBRARIAN_SYNC, "update librarian",
+                           "Invalid location", ebook_location)
+            unmatched += 1
             continue  # invalid
-        for collection_label in ebook_collection_labels_list:
-            # find collection by label
-            collection_idx = find_collection(db_collections, collection_label)
-            if collection_idx == -1:
-                # creating new collection object
-                db_collections.append(Collection(uuid.uuid4(),
-                                                 collection_label,
-                                                 is_new=True))
-                collection_idx = len(db_collections)-1
-            for ebook_idx in ebook_idx_list:
-                # udpate ebook
-                db_ebooks[ebook_idx].add_collection(
-                    db_collections[collection_idx])
-                # update collection
-                db_collections[collection_idx].add_ebook(db_ebooks[ebook_idx])
+        matched += 1
+        update_librarian_entry(catalog, ebooks, ebook_collection_labels_list)
+
+    regexp_matches = RegexMatcher(
+        [ebook_location for (ebook_location, _) in regexp_entries]
+        ).match(catalog.ebooks)
+    for (ebook_location, ebook_collection_labels_list) in regexp_entries:
+        ebooks = regexp_matches[ebook_location]
+        if ebooks == []:
+            log_aggregated(LIBRARIAN_SYNC, "update librarian",
+                           "Invalid location", ebook_location)
+            unmatched += 1
+            continue  # invalid
+        matched += 1
+        update_librarian_entry(catalog, ebooks, ebook_collection_labels_list)
+
+    count("entries matched", matched)
+    count("entries unmatched", unmatched)
 
     # remove empty collections:
-    db_collections = [c for c in db_collections if len(c.ebooks) != 0]
+    catalog.remove_empty_collections()
 
-    return db_ebooks, db_collections
+    return catalog
 
 
 # Return a cdeKey, cdeType couple from a legacy json hash
@@ -136,22 +455,19 @@ def parse_legacy_hash(legacy_hash):
         cdekey, cdetype = legacy_hash[1:].split('^')
     else:
         cdekey = legacy_hash
-        # Legacy md5 hash of the full path, there's no cdeType, assume EBOK.
+        # Either a bare cdeKey, or a legacy md5 hash of the full path
+        # (see LEGACY_PATH_HASH). There's no cdeType, assume EBOK.
         cdetype = u'EBOK'
     return cdekey, cdetype
 
 
-def update_lists_from_calibre_plugin_json(db_ebooks, db_collections,
-                                          collection_contents):
+def update_lists_from_calibre_plugin_json(catalog, collection_contents):
 
-    for (collection_label, ebook_hashes_list) in collection_contents.items():
-        # find collection by label
-        collection_idx = find_collection(db_collections, collection_label)
-        if collection_idx == -1:
-            # creating new collection object
-            db_collections.append(Collection(uuid.uuid4(), collection_label,
-                                             is_new=True))
-            collection_idx = len(db_collections)-1
+    # collection_contents is a stream of (label, hashes), where the same label
+    # may come up more than once
+    matched = unmatched = resolved_by_path = 0
+    for (collection_label, ebook_hashes_list) in collection_contents:
+        collection = find_or_create_collection(catalog, collection_label)
 
         for ebook_hash in ebook_hashes_list:
             cdekey, cdetype = parse_legacy_hash(ebook_hash)
@@ -159,118 +475,508 @@ def update_lists_from_calibre_plugin_json(db_ebooks, db_collections,
             # unless we run into the extremely unlikely case of two items with
             # the same cdeKey, but different cdeTypes
             # find ebook by cdeKey
-            ebook_idx_list = find_ebook(db_ebooks, cdekey)
-            if ebook_idx_list == []:
-                log(LIBRARIAN_SYNC, "update calibre",
-                    "Couldn't match a db uuid to cdeKey %s"
-                    "(book not on device?)" % cdekey,
-                    "W", display=False)
+            ebooks = catalog.find_ebooks(cdekey)
+            if ebooks == [] and LEGACY_PATH_HASH.match(ebook_hash):
+                # not a cdeKey after all: find ebook by path hash
+                ebooks = catalog.find_ebooks_by_path_hash(ebook_hash)
+                if ebooks != []:
+                    resolved_by_path += 1
+            if ebooks == []:
+                log_aggregated(LIBRARIAN_SYNC, "update calibre",
+                               "Couldn't match a db uuid to cdeKey "
+                               "(book not on device?)", cdekey)
+                unmatched += 1
                 continue  # invalid
-            for ebook_idx in ebook_idx_list:
+            matched += 1
+            for ebook in ebooks:
                 # update ebook
-                db_ebooks[ebook_idx].add_collection(
-                    db_collections[collection_idx])
+                ebook.add_collection(collection)
                 # update collection
-                db_collections[collection_idx].add_ebook(db_ebooks[ebook_idx])
+                collection.add_ebook(ebook)
+
+    count("entries matched", matched)
+    count("entries unmatched", unmatched)
+    if resolved_by_path:
+        count("legacy path hashes resolved", resolved_by_path)
+        log(LIBRARIAN_SYNC, "update calibre",
+            "%d legacy path hashes resolved." % resolved_by_path, "W",
+            display=False)
 
     # remove empty collections:
-    db_collections = [c for c in db_collections if len(c.ebooks) != 0]
+    catalog.remove_empty_collections()
 
-    return db_ebooks, db_collections
+    return catalog
 
 
 # -------- Main
-def update_cc_db(c, complete_rebuild=True, source="folders"):
-    # build dictionaries of ebooks/collections with their uuids
-    db_ebooks, db_collections = parse_entries(c,
-                                              ignore_empty_collections=False)
+def build_commands(cc, catalog, complete_rebuild=True, source="folders",
+                   collections_contents=None):
+    """Match catalog against source (or its already read contents), and
+    queue the commands to bring cc.db in line with it (they start being
+    sent as soon as they can).
+    Returns the collections cc.db is left with."""
+    # NOTE: a rebuild keeps the existing collections around, so that the
+    # ones we still need are matched by label, and keep their uuid.
+    # Only their membership is updated, and only if it actually changed.
+    # Whatever's left empty at the end is deleted.
+    existing_collections = list(catalog.collections)
 
-    # object that will handle all db updates
-    cc = CCUpdate()
-
-    if complete_rebuild:
-        # clear all current collections
-        for (i, eb) in enumerate(db_ebooks):
-            db_ebooks[i].original_collections = []
-        for (i, eb) in enumerate(db_collections):
-            db_collections[i].original_ebooks = []
-        for collection in db_collections:
-            cc.delete_collection(collection.uuid)
-        db_collections = []
-
-    if source == "calibre_plugin":
-        collections_contents = parse_calibre_plugin_config(CALIBRE_PLUGIN_FILE)
-        db_ebooks, db_collections = update_lists_from_calibre_plugin_json(
-            db_ebooks, db_collections, collections_contents)
-    else:
+    if collections_contents is None:
+        collections_contents = read_source(source)
+    with phase("match"):
+        if source == "calibre_plugin":
+            catalog = update_lists_from_calibre_plugin_json(
+                catalog, collections_contents)
+        else:
+            catalog = update_lists_from_librarian_json(catalog,
+                                                       collections_contents)
+
+    with phase("build commands"):
+        kept_collections = set(id(coll) for coll in catalog.collections)
+        remaining_collections = list(catalog.collections)
+        if complete_rebuild:
+            # delete the collections that weren't reused
+            for collection in existing_collections:
+                if id(collection) not in kept_collections:
+                    cc.delete_collection(collection.uuid)
+        else:
+            # the ones the source didn't mention are left alone
+            remaining_collections.extend(
+                collection for collection in existing_collections
+                if id(collection) not in kept_collections)
+
+        # create new collections in db
+        for collection in catalog.collections:
+            if collection.is_new:
+                cc.insert_new_collection_entry(collection.uuid,
+                                               collection.label)
+        # NOTE: from now on, commands are sent while the next ones are
+        # being worked out. Deletions and insertions go first, together.
+        cc.release()
+
+        # update all 'Collections' entries with new members
+        for collection in catalog.collections:
+            if collection.membership_changed():
+                cc.update_collections_entry(collection.uuid,
+                                            sorted(e.uuid
+                                                   for e in collection.ebooks))
+                cc.release(cc.batch_size)
+
+        # if firmware requires updating ebook entries
+        if cc.is_cc_aware:
+            # update all Item:Ebook entries with the number of collections
+            # it belongs to, if that's not what cc.db has (an interrupted
+            # run may have left it out of date)
+            for ebook in catalog.ebooks:
+                stored_count = ebook.collection_count
+                if stored_count is None:
+                    # no p_collectionCount column
+                    stored_count = len(ebook.original_collections)
+                if len(ebook.collections) != stored_count:
+                    cc.update_ebook_entry(ebook.uuid, len(ebook.collections))
+                    cc.release(cc.batch_size)
+
+    return remaining_collections
+
+
+def prefetch_file(config_file):
+    # the json files are only read while matching (see JSONObjectReader):
+    # make sure they're in the page cache by then
+    with open(config_file, "rb") as f:
+        while f.read(JSON_CHUNK_SIZE):
+            pass
+
+
+def read_source(source):
+    with phase("read source"):
         if source == "folders":
             # parse folder structure
-            collections_contents = list_folder_contents()
+            return list_folder_contents(full_scan=FULL_SCAN)
+        elif source == "calibre_plugin":
+            prefetch_file(CALIBRE_PLUGIN_FILE)
+            return parse_calibre_plugin_config(CALIBRE_PLUGIN_FILE)
         else:
             # parse tags json
-            collections_contents = parse_config(TAGS)
-        db_ebooks, db_collections = update_lists_from_librarian_json(
-            db_ebooks, db_collections, collections_contents)
-
-    # updating collections, creating them if necessary
-    for collection in db_collections:
-        if collection.is_new:
-            # create new collections in db
-            cc.insert_new_collection_entry(collection.uuid, collection.label)
-        # update all 'Collections' entries with new members
-        collection.sort_ebooks()
-        if collection.ebooks != collection.original_ebooks:
-            cc.update_collections_entry(collection.uuid,
-                                        [e.uuid for e in collection.ebooks])
+            prefetch_file(TAGS)
+            return parse_config(TAGS)
+
+
+class Prefetch(object):
+    """Calls func(*args) on a worker thread, result() waits for it."""
+    def __init__(self, func, *args):
+        self.value = None
+        self.error = None
+        self.elapsed = 0.0
+        self.thread = threading.Thread(target=self._run, name="prefetch",
+                                       args=(func, args))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self, func, args):
+        start = time.time()
+        try:
+            self.value = func(*args)
+        except Exception:
+            self.error = sys.exc_info()
+        self.elapsed = time.time() - start
+
+    def result(self):
+        self.thread.join()
+        if self.error is not None:
+            six.reraise(*self.error)
+        return self.value
+
+
+def update_cc_db(c, complete_rebuild=True, source="folders"):
+    start = time.time()
+    # the source doesn't depend on cc.db, read both at the same time
+    source_reader = Prefetch(read_source, source)
+    # build dictionaries of ebooks/collections with their uuids
+    with phase("read cc.db"):
+        catalog, cache_state = load_catalog(c)
+    cc_db_time = time.time() - start
+    collections_contents = source_reader.result()
+    elapsed = time.time() - start
+    # NOTE: both take a bit longer side by side than on their own (they
+    # share the CPU), so that's an upper bound
+    log(LIBRARIAN_SYNC, "update_cc_db",
+        "Read cc.db (%.02fs) and %s (%.02fs) in %.02fs, saving up to %.02fs."
+        % (cc_db_time, source, source_reader.elapsed, elapsed,
+           cc_db_time + source_reader.elapsed - elapsed), display=False)
+
+    # object that will handle all db updates
+    cc = CCUpdate(journal=JOURNAL)
+    try:
+        build_commands(cc, catalog, complete_rebuild, source,
+                       collections_contents)
+
+        # send all the commands to update the database
+        with phase("send"):
+            sent = cc.execute()
+    finally:
+        if cc.released:
+            invalidate_catalog_cache()
+    if not cc.released:
+        # nothing changed: next time, no need to read cc.db again
+        save_catalog(catalog, cache_state)
+    return sent
+
 
-    # if firmware requires updating ebook entries
-    if cc.is_cc_aware:
-        # update all Item:Ebook entries with the number of collections
-        # it belongs to.
-        for ebook in db_ebooks:
-            if len(ebook.collections) != len(ebook.original_collections):
-                cc.update_ebook_entry(ebook.uuid, len(ebook.collections))
+def sorted_entries(entries):
+    """Sort (key, value) entries by key, and drop duplicate keys (the last
+    one wins, like it would in a dict)."""
+    entries = sorted(entries, key=lambda entry: entry[0])
+    for (i, entry) in enumerate(entries):
+        if i + 1 == len(entries) or entries[i + 1][0] != entry[0]:
+            yield entry
 
-    # send all the commands to update the database
-    cc.execute()
+
+def write_json_export(export_file, entries):
+    """Write (key, value) entries, sorted by key, as a json object (exactly
+    like json.dumps(..., sort_keys=True, indent=2) would), one at a time.
+    The file is only replaced if that changed anything.
+    Returns the number of entries, and whether the file changed."""
+    tmp_file = export_file + u".tmp"
+    written = 0
+    with codecs.open(tmp_file, "w", "utf8", buffering=JSON_CHUNK_SIZE) as f:
+        for (key, value) in entries:
+            f.write(u",\n  " if written else u"{\n  ")
+            f.write(json.dumps(key, ensure_ascii=False))
+            f.write(u": ")
+            # nested one level deeper
+            f.write(json.dumps(value, sort_keys=True, indent=2,
+                               separators=(',', ': '),
+                               ensure_ascii=False).replace(u"\n", u"\n  "))
+            written += 1
+        f.write(u"\n}" if written else u"{}")
+
+    if os.path.exists(export_file) and \
+       filecmp.cmp(tmp_file, export_file, shallow=False):
+        os.remove(tmp_file)
+        return written, False
+    os.rename(tmp_file, export_file)
+    return written, True
+
+
+def read_last_access(export_file):
+    # label@locale: (items, lastAccess), from a previous export
+    last_access = {}
+    try:
+        for (key, value) in JSONObjectReader(export_file, msg="Exporting"):
+            last_access[key] = (value["items"], value["lastAccess"])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        pass
+    return last_access
 
 
 def export_existing_collections(c):
-    db_ebooks, db_collections = parse_entries(c, ignore_empty_collections=True)
+    with phase("read cc.db"):
+        catalog, cache_state = load_catalog(c)
+        save_catalog(catalog, cache_state)
+        catalog.remove_empty_collections(original=True)
 
-    export = {}
-    for ebook in db_ebooks:
-        export.update(ebook.to_librarian_json())
+    with phase("write export"):
+        ebooks = sorted_entries(
+            (get_relative_path(ebook.location), ebook)
+            for ebook in catalog.ebooks if ebook.original_collections)
+        exported, changed = write_json_export(
+            EXPORT, (ebook.librarian_entry() for (_, ebook) in ebooks))
+    count("ebooks exported", exported)
+    log(LIBRARIAN_SYNC, "export", "%s: %d ebooks%s."
+        % (EXPORT, exported, "" if changed else ", unchanged"),
+        display=False)
 
-    with codecs.open(EXPORT, "w", "utf8") as export_json:
-        export_json.write(json.dumps(export, sort_keys=True, indent=2,
-                                     separators=(',', ': '),
-                                     ensure_ascii=False))
+    with phase("write export"):
+        # only once per run
+        locale_name = locale.getdefaultlocale()[0]
+        now = int(time.time())
+        # keep the lastAccess of whatever didn't change, so that the calibre
+        # plugin doesn't think it did
+        last_access = read_last_access(CALIBRE_PLUGIN_FILE)
 
-    export = {}
-    for collection in db_collections:
-        export.update(collection.to_calibre_plugin_json())
+        def calibre_plugin_entries(collections):
+            for (_, collection) in collections:
+                key, items = collection.calibre_plugin_entry(locale_name)
+                previous = last_access.get(key)
+                yield key, {"items": items,
+                            "lastAccess": previous[1]
+                            if previous is not None and previous[0] == items
+                            else now}
 
-    with codecs.open(CALIBRE_PLUGIN_FILE, "w", "utf8") as export_json:
-        export_json.write(json.dumps(export, sort_keys=True, indent=2,
-                                     separators=(',', ': '),
-                                     ensure_ascii=False))
+        collections = sorted_entries(
+            (u"%s@%s" % (collection.label, locale_name), collection)
+            for collection in catalog.collections)
+        exported, changed = write_json_export(
+            CALIBRE_PLUGIN_FILE, calibre_plugin_entries(collections))
+    count("collections exported", exported)
+    log(LIBRARIAN_SYNC, "export", "%s: %d collections%s."
+        % (CALIBRE_PLUGIN_FILE, exported, "" if changed else ", unchanged"),
+        display=False)
 
 
 def delete_all_collections(c):
     # build dictionaries of ebooks/collections with their uuids
-    db_ebooks, db_collections = parse_entries(c,
-                                              ignore_empty_collections=False)
+    with phase("read cc.db"):
+        catalog, cache_state = load_catalog(c)
 
     # object that will handle all db updates
-    cc = CCUpdate()
-    for collection in db_collections:
+    cc = CCUpdate(journal=JOURNAL)
+    for collection in catalog.collections:
         cc.delete_collection(collection.uuid)
-    cc.execute()
+    try:
+        with phase("send"):
+            sent = cc.execute()
+    finally:
+        if cc.released:
+            invalidate_catalog_cache()
+    if not cc.released:
+        save_catalog(catalog, cache_state)
+    return sent
+
+
+def drop_applied_commands(c, commands):
+    """The last batch sent before being interrupted might have gone through:
+    don't insert what's already there, or delete what's already gone."""
+    uuids = [details["uuid"] for command in commands
+             for (action, details) in command.items()
+             if action in ("insert", "delete")]
+    existing = set()
+    for i in range(0, len(uuids), SQLITE_MAX_VARIABLES):
+        chunk = uuids[i:i + SQLITE_MAX_VARIABLES]
+        c.execute(SELECT_EXISTING_UUIDS % u",".join(u"?" * len(chunk)), chunk)
+        existing.update(row[0] for row in c.fetchall())
+    return [command for command in commands
+            if not ("insert" in command and
+                    command["insert"]["uuid"] in existing) and
+            not ("delete" in command and
+                 command["delete"]["uuid"] not in existing)]
+
+
+def resume_cc_update(c):
+    cc = CCUpdate.from_journal(JOURNAL)
+    if cc is None:
+        return True
+    with phase("read cc.db"):
+        cc.commands = drop_applied_commands(c, cc.commands)
+    try:
+        with phase("send"):
+            return cc.execute()
+    finally:
+        if cc.released:
+            invalidate_catalog_cache()
+
+
+# -------- Watch
+WATCH_PIDFILE = u"/tmp/librariansync_watch.pid"
+
+
+def cc_db_version(cc_db):
+    # changes whenever another connection (the ccat service, the indexer...)
+    # commits something to cc.db
+    row = cc_db.execute(u"pragma data_version").fetchone()
+    if row is not None:
+        return row[0]
+    # SQLite older than 3.8.4: settle for the files themselves
+    versions = []
+    for suffix in CC_DB_SUFFIXES:
+        try:
+            st = os.stat(KINDLE_DB_PATH + suffix)
+            versions.append((st.st_size, st.st_mtime))
+        except OSError:
+            versions.append(None)
+    return tuple(versions)
 
-# -------------------------------------------------------
-if __name__ == "__main__":
 
+def cc_db_fingerprint(cursor):
+    # the firmware writes to cc.db all the time (e.g., lastAccess, whenever a
+    # book is opened), which doesn't change anything for us
+    cursor.execute(CC_DB_FINGERPRINT, (KINDLE_EBOOKS_ROOT + u"*",))
+    return tuple(tuple(row) for row in cursor.fetchall())
+
+
+def is_watched_folder(name):
+    # no hidden folders, no sidecars (written to while reading)
+    return not name.startswith(u".") and not name.lower().endswith(u".sdr")
+
+
+def is_relevant_change(name, is_dir):
+    return is_watched_folder(name) if is_dir else \
+        os.path.splitext(name.lower())[1] in SUPPORTED_EXTENSIONS
+
+
+def watched_pid():
+    try:
+        with open(WATCH_PIDFILE, "r") as f:
+            pid = int(f.read())
+        os.kill(pid, 0)
+        return pid
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def stop_watching():
+    pid = watched_pid()
+    if pid is None:
+        log(LIBRARIAN_SYNC, "watch", "Not watching.")
+        return True
+    os.kill(pid, signal.SIGTERM)
+    log(LIBRARIAN_SYNC, "watch", "Stopped watching.")
+    return True
+
+
+def daemonize():
+    # the usual double fork, so that KUAL gets its menu back right away
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+
+
+def watch(complete_rebuild=True, source="folders", daemon=False):
+    """Keep collections in sync with source, until SIGTERM."""
+    # only needed here, and loads ctypes
+    from watcher import Watcher
+
+    if watched_pid() is not None:
+        log(LIBRARIAN_SYNC, "watch", "Already watching.", "W")
+        return False
+    log(LIBRARIAN_SYNC, "watch", "Watching for changes...")
+    # from now on, stay off the screen
+    set_headless()
+    if daemon:
+        daemonize()
+    with open(WATCH_PIDFILE, "w") as f:
+        f.write("%d" % os.getpid())
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    watcher = Watcher()
+    if source == "folders":
+        watcher.watch_tree(KINDLE_EBOOKS_ROOT, "source",
+                           prune=lambda name: not is_watched_folder(name),
+                           relevant=is_relevant_change)
+    elif source == "calibre_plugin":
+        watcher.watch_file(CALIBRE_PLUGIN_FILE, "source")
+    else:
+        watcher.watch_file(TAGS, "source")
+    # new ebooks only show up once the indexer has added them to cc.db
+    for suffix in CC_DB_SUFFIXES:
+        watcher.watch_file(KINDLE_DB_PATH + suffix, "cc.db", in_place=True)
+
+    # catalog, as of cc.db's version & fingerprint
+    catalog = None
+    version = None
+    fingerprint = None
+    # sync once right away
+    changed = set(["source"])
+    try:
+        with open_cc_db() as cc_db:
+            c = cc_db.cursor()
+            while True:
+                if not os.path.isdir(KINDLE_EBOOKS_ROOT):
+                    # the userstore is gone (exported over USB?), don't
+                    # mistake that for an empty library
+                    log(LIBRARIAN_SYNC, "watch",
+                        "%s is missing, waiting." % KINDLE_EBOOKS_ROOT,
+                        display=False)
+                elif catalog is not None and "source" not in changed and \
+                        cc_db_version(cc_db) != version and \
+                        cc_db_fingerprint(c) == fingerprint:
+                    # someone else wrote to cc.db, but not to anything we
+                    # sync: nothing to do
+                    version = cc_db_version(cc_db)
+                elif catalog is None or "source" in changed or \
+                        cc_db_version(cc_db) != version:
+                    start = time.time()
+                    cc = None
+                    try:
+                        # only read cc.db again if someone else changed
+                        # what we sync in it
+                        if catalog is None or \
+                           cc_db_version(cc_db) != version and \
+                           cc_db_fingerprint(c) != fingerprint:
+                            fingerprint = cc_db_fingerprint(c)
+                            catalog = parse_entries(c)
+                        cc = CCUpdate()
+                        collections = build_commands(cc, catalog,
+                                                     complete_rebuild, source)
+                        sent = cc.execute()
+                        if cc.released:
+                            invalidate_catalog_cache()
+                        if sent:
+                            catalog.commit(collections)
+                            version = cc_db_version(cc_db)
+                            fingerprint = cc_db_fingerprint(c)
+                        else:
+                            catalog = None
+                    except Exception:
+                        log(LIBRARIAN_SYNC, "watch",
+                            "Couldn't sync collections.", "E", display=False)
+                        traceback.print_exc()
+                        if cc is not None:
+                            cc.abort()
+                        # no idea what it looks like anymore
+                        catalog = None
+                    flush_aggregated()
+                    log(LIBRARIAN_SYNC, "watch",
+                        "Synced in %.02fs." % (time.time() - start),
+                        display=False)
+                changed = watcher.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+        if watched_pid() == os.getpid():
+            os.remove(WATCH_PIDFILE)
+    log(LIBRARIAN_SYNC, "watch", "Stopped.", display=False)
+    return True
+
+
+# -------------------------------------------------------
+def main(argv=None):
     parser = argparse.ArgumentParser(description='Librarian Sync. Build Kindle'
                                      'collections, fast and without style.')
 
@@ -295,50 +1001,127 @@ if __name__ == "__main__":
     parser.add_argument('--rebuild-calibre', dest='rebuild_calibre',
                         action='store_true', default=False,
                         help='rebuild collections from calibre kindle plugin.')
+    parser.add_argument('--resume', dest='resume',
+                        action='store_true', default=False,
+                        help='send what an interrupted run left unsent.')
+    parser.add_argument('--headless', dest='headless',
+                        action='store_true', default=False,
+                        help='never display anything on screen, '
+                        'only log to syslog.')
+    parser.add_argument('-w', '--watch', dest='watch',
+                        action='store_true', default=False,
+                        help='keep watching for changes, and sync '
+                        'collections with the given mode.')
+    parser.add_argument('--daemon', dest='daemon',
+                        action='store_true', default=False,
+                        help='with --watch, run in the background.')
+    parser.add_argument('--stop-watch', dest='stop_watch',
+                        action='store_true', default=False,
+                        help='stop watching for changes.')
+    parser.add_argument('--max-memory', dest='max_memory', type=int,
+                        default=None, metavar='MB',
+                        help='stop rather than use more memory than that '
+                        'while reading cc.db.')
+    parser.add_argument('--full-scan', dest='full_scan',
+                        action='store_true', default=False,
+                        help='with --folders, list every folder again, even '
+                        'those that look unchanged since the last scan.')
+    parser.add_argument('--profile', dest='profile',
+                        action='store_true', default=False,
+                        help='time each step, and write a report to %s.'
+                        % PROFILE_REPORT)
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    if args.max_memory:
+        global MAX_MEMORY
+        MAX_MEMORY = args.max_memory * 1024 * 1024
+    if args.full_scan:
+        global FULL_SCAN
+        FULL_SCAN = True
+    if args.headless:
+        set_headless()
+    if args.profile:
+        PROFILER.enable()
+
+    if args.stop_watch:
+        return stop_watching()
+    if args.watch:
+        modes = [(args.rebuild, True, "librarian"),
+                 (args.update, False, "librarian"),
+                 (args.folders, True, "folders"),
+                 (args.rebuild_calibre, True, "calibre_plugin"),
+                 (args.update_calibre, False, "calibre_plugin")]
+        selected = [(complete_rebuild, source)
+                    for (chosen, complete_rebuild, source) in modes if chosen]
+        if not selected:
+            parser.error("--watch needs one of --rebuild, --update, "
+                         "--folders, --rebuild-calibre, --update-calibre.")
+        complete_rebuild, source = selected[0]
+        return watch(complete_rebuild, source, daemon=args.daemon)
 
     start = time.time()
     log(LIBRARIAN_SYNC, "main", "Starting...")
+    # whether everything was sent
+    ok = True
     try:
-        with sqlite3.connect(KINDLE_DB_PATH) as cc_db:
+        with open_cc_db() as cc_db:
             c = cc_db.cursor()
             if args.rebuild:
                 log(LIBRARIAN_SYNC, "rebuild",
                     "Rebuilding collections (librarian)...")
-                update_cc_db(c, complete_rebuild=True,
-                             source="librarian")
+                ok = update_cc_db(c, complete_rebuild=True,
+                                  source="librarian")
             elif args.update:
                 log(LIBRARIAN_SYNC, "update",
                     "Updating collections (librarian)...")
-                update_cc_db(c, complete_rebuild=False,
-                             source="librarian")
+                ok = update_cc_db(c, complete_rebuild=False,
+                                  source="librarian")
             elif args.folders:
                 log(LIBRARIAN_SYNC, "rebuild_from_folders",
                     "Rebuilding collections (folders)...")
-                update_cc_db(c, complete_rebuild=True,
-                             source="folders")
+                ok = update_cc_db(c, complete_rebuild=True,
+                                  source="folders")
             elif args.rebuild_calibre:
                 log(LIBRARIAN_SYNC, "rebuild_from_calibre_plugin_json",
                     "Rebuilding collections (Calibre)...")
-                update_cc_db(c, complete_rebuild=True,
-                             source="calibre_plugin")
+                ok = update_cc_db(c, complete_rebuild=True,
+                                  source="calibre_plugin")
             elif args.update_calibre:
                 log(LIBRARIAN_SYNC, "update_from_calibre_plugin_json",
                     "Updating collections (Calibre)...")
-                update_cc_db(c, complete_rebuild=False,
-                             source="calibre_plugin")
+                ok = update_cc_db(c, complete_rebuild=False,
+                                  source="calibre_plugin")
+            elif args.resume:
+                log(LIBRARIAN_SYNC, "resume",
+                    "Resuming interrupted sync...")
+                ok = resume_cc_update(c)
             elif args.export:
                 log(LIBRARIAN_SYNC, "export", "Exporting collections...")
                 export_existing_collections(c)
             elif args.delete:
                 log(LIBRARIAN_SYNC, "delete", "Deleting all collections...")
-                delete_all_collections(c)
+                ok = delete_all_collections(c)
+    except MemoryError as e:
+        log(LIBRARIAN_SYNC, "main", "Not enough memory (%s)." % e, "E")
+        flush_aggregated()
+        return False
     except:
         log(LIBRARIAN_SYNC, "main", "Something went very wrong.", "E")
         traceback.print_exc()
+        flush_aggregated()
+        return False
     else:
-        log(LIBRARIAN_SYNC, "main", "Done in %.02fs." % (time.time()-start))
+        flush_aggregated()
+        if ok:
+            log(LIBRARIAN_SYNC, "main",
+                "Done in %.02fs." % (time.time()-start))
+        PROFILER.report(mode=[arg for arg in (argv or sys.argv[1:])
+                              if arg != "--profile"])
         # Take care of buffered IO & KUAL's IO redirection...
         sys.stdout.flush()
         sys.stderr.flush()
+        return ok
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,26 @@
 from __future__ import absolute_import
 
+import gc
 import os
 import re
-import locale
+import sys
+import json
+import hashlib
 import time
 import six
+from collections import OrderedDict
+from contextlib import contextmanager
+from six.moves import cPickle as pickle
+try:
+    from os import scandir
+except ImportError:
+    # Python 2: use the backport if it's around, else listdir + stat
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
-from kindle_logging import log, LIBRARIAN_SYNC
+from kindle_logging import log, log_aggregated, LIBRARIAN_SYNC
 
 KINDLE_EBOOKS_ROOT = u"/mnt/us/documents/"
 
@@ -31,15 +45,108 @@ SUPPORTED_EXTENSIONS = [u".azw",
 
 
 # -------- Folders
-def list_folder_contents():
+# per-directory snapshot of the last folder scan, relative to the extension
+FOLDERS_SNAPSHOT = u"folders_snapshot.json"
+FOLDERS_SNAPSHOT_VERSION = 1
+# FAT only has a 2s mtime resolution: a directory modified that close to the
+# last scan might have been changed right after we listed it.
+MTIME_RESOLUTION = 2
+
+
+def list_directory(path):
+    files = []
+    subdirs = []
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.name)
+            elif os.path.splitext(entry.name.lower())[1] in \
+                    SUPPORTED_EXTENSIONS:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                subdirs.append(name)
+            elif os.path.splitext(name.lower())[1] in SUPPORTED_EXTENSIONS:
+                files.append(name)
+    return files, subdirs
+
+
+def load_folders_snapshot(snapshot_file):
+    try:
+        with open(snapshot_file, "r") as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") == FOLDERS_SNAPSHOT_VERSION and \
+           snapshot.get("root") == KINDLE_EBOOKS_ROOT:
+            return snapshot
+    except (IOError, OSError, ValueError):
+        pass
+    return {"scanned": 0, "dirs": {}}
+
+
+def save_folders_snapshot(snapshot_file, scanned, dirs):
+    try:
+        tmp_file = snapshot_file + u".tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"version": FOLDERS_SNAPSHOT_VERSION,
+                       "root": KINDLE_EBOOKS_ROOT,
+                       "scanned": scanned,
+                       "dirs": dirs}, f)
+        os.rename(tmp_file, snapshot_file)
+    except (IOError, OSError, ValueError) as e:
+        # not fatal, we'll just do a full scan next time
+        log(LIBRARIAN_SYNC, "folders snapshot",
+            "Couldn't save folders snapshot (%s)" % e, "W", display=False)
+
+
+def list_folder_contents(snapshot_file=None, full_scan=False):
+    """full_scan: list every folder again, even those that don't look like
+    they changed (their contents can change without their mtime, e.g. when
+    written to by some other OS)"""
+    if snapshot_file is None:
+        snapshot_file = FOLDERS_SNAPSHOT
+    snapshot = {"scanned": 0, "dirs": {}} if full_scan else \
+        load_folders_snapshot(snapshot_file)
+    # only trust directories that hadn't changed for a while when last listed
+    trusted_before = snapshot["scanned"] - MTIME_RESOLUTION
+    scanned = time.time()
+
     folder_contents = {}
-    for root, dirs, files in os.walk(KINDLE_EBOOKS_ROOT):
-        for f in [get_relative_path(os.path.join(root, el))
-                  for el in files
-                  if os.path.splitext(el.lower())[1] in SUPPORTED_EXTENSIONS]:
-            # if not directly in KINDLE_EBOOKS_ROOT
-            if get_relative_path(root) != u"":
-                folder_contents[f] = [get_relative_path(root)]
+    # relative dir: [mtime, [ebook file names], [subdirectory names]]
+    dirs = {}
+    relisted = 0
+    pending = [u""]
+    while pending:
+        relative_dir = pending.pop()
+        path = os.path.join(KINDLE_EBOOKS_ROOT, relative_dir)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            continue
+        known = snapshot["dirs"].get(relative_dir)
+        if known is not None and known[0] == mtime and \
+           mtime < trusted_before:
+            files, subdirs = known[1], known[2]
+        else:
+            try:
+                files, subdirs = list_directory(path)
+            except OSError:
+                continue
+            relisted += 1
+        dirs[relative_dir] = [mtime, files, subdirs]
+
+        # if not directly in KINDLE_EBOOKS_ROOT
+        if relative_dir != u"":
+            for f in files:
+                folder_contents[os.path.join(relative_dir, f)] = \
+                    [relative_dir]
+        pending.extend(os.path.join(relative_dir, d) for d in subdirs)
+
+    log(LIBRARIAN_SYNC, "list_folder_contents",
+        "Re-listed %d out of %d folders." % (relisted, len(dirs)),
+        display=False)
+    save_folders_snapshot(snapshot_file, scanned, dirs)
     return folder_contents
 
 
@@ -51,52 +158,116 @@ def get_relative_path(path):
 
 
 # -------- Ebooks and Collections
+if sys.version_info >= (3, 7):
+    # dicts keep insertion order, use their keys as an ordered set
+    OrderedSet = dict
+else:
+    OrderedSet = OrderedDict
+
+# labels & cdeTypes are heavily repeated, only keep one copy of each.
+# (NOTE: intern() only takes bytestrings on Python 2)
+INTERNED_STRINGS = {}
+
+
+def intern_string(s):
+    return INTERNED_STRINGS.setdefault(s, s)
+
+
+@contextmanager
+def gc_paused():
+    # for bursts of allocations that are all going to be kept: the cyclic
+    # garbage collector would only waste its time going through them
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def uuid_digest(uuid):
+    # 64 bits of an md5 hash, stable across runs (unlike hash())
+    return int(hashlib.md5(six.text_type(uuid).encode("utf8"))
+               .hexdigest()[:16], 16)
+
+
+def path_hash(location):
+    # what the legacy calibre plugin json used for books without a cdeKey:
+    # the md5 of their full path (/mnt/us/documents/...)
+    return hashlib.md5(six.text_type(location).encode("utf8")).hexdigest()
+
+
 class Ebook(object):
-    def __init__(self, uuid, location, cdekey, cdetype):
+    __slots__ = ("uuid", "location", "cdekey", "cdetype", "collection_count",
+                 "digest", "original_collections", "collections")
+
+    def __init__(self, uuid, location, cdekey, cdetype, collection_count=None,
+                 digest=None):
         self.uuid = uuid
         self.location = location
         self.cdekey = cdekey
-        self.cdetype = cdetype
-        self.original_collections = []
-        self.collections = []
+        self.cdetype = intern_string(cdetype)
+        # as stored in cc.db, if it knows about it
+        self.collection_count = collection_count
+        self.digest = uuid_digest(uuid) if digest is None else digest
+        # only a handful of collections per ebook: small, ordered tuples
+        self.original_collections = ()
+        self.collections = ()
 
     def __eq__(self, other):
         # comparing uuids should be enough
         return self.uuid == other.uuid
 
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.uuid)
+
     def add_collection(self, collection, original=False):
         if original:
-            self.original_collections.append(collection)
+            if collection not in self.original_collections:
+                self.original_collections += (collection,)
         else:
-            self.collections.append(collection)
+            if collection not in self.collections:
+                self.collections += (collection,)
 
-    def to_librarian_json(self):
-        if self.original_collections == []:
-            return {}
-        else:
-            return {
-                get_relative_path(self.location):
-                    [coll.label for coll in self.original_collections]
-                    }
+    def librarian_entry(self):
+        # (relative path, [collection label, ...]), for exports
+        return (get_relative_path(self.location),
+                [coll.label for coll in self.original_collections])
 
 
 class Collection(object):
+    __slots__ = ("uuid", "label", "original_ebooks", "ebooks", "is_new",
+                 "original_digest", "digest")
+
     def __init__(self, uuid, label, is_new=False):
         self.uuid = uuid
-        self.label = label
-        self.original_ebooks = []
-        self.ebooks = []
+        self.label = intern_string(label)
+        # ordered sets of ebooks (.keys() of an OrderedSet)
+        self.original_ebooks = OrderedSet()
+        self.ebooks = OrderedSet()
         self.is_new = is_new
-
-    def sort_ebooks(self):
-        self.ebooks.sort(key=lambda ebook: ebook.uuid)
-        self.original_ebooks.sort(key=lambda ebook: ebook.uuid)
+        # XOR of the ebooks' digests, order-independent, kept up to date as
+        # ebooks are added, so that comparing memberships is O(1)
+        self.original_digest = 0
+        self.digest = 0
 
     def add_ebook(self, ebook, original=False):
         if original:
-            self.original_ebooks.append(ebook)
+            if ebook not in self.original_ebooks:
+                self.original_ebooks[ebook] = None
+                self.original_digest ^= ebook.digest
         else:
-            self.ebooks.append(ebook)
+            if ebook not in self.ebooks:
+                self.ebooks[ebook] = None
+                self.digest ^= ebook.digest
+
+    def membership_changed(self):
+        return len(self.ebooks) != len(self.original_ebooks) or \
+            self.digest != self.original_digest
 
     # Build a legacy hashes list from the cdeType & cdeKey
     # couples of our book list
@@ -112,49 +283,264 @@ class Collection(object):
                     # Proper or fake ASIN set, build the hash
                     hashes_list.append('#{}^{}'.format(e.cdekey, e.cdetype))
             else:
-                log(LIBRARIAN_SYNC, "legacy hash building",
-                    "Book %s has no cdeKey?! Skipping it."
-                    "(sideloaded book?)" % e.location,
-                    "W", display=False)
+                log_aggregated(LIBRARIAN_SYNC, "legacy hash building",
+                               "Book has no cdeKey?! Skipping it. "
+                               "(sideloaded book?)", e.location)
         return hashes_list
 
-    def to_calibre_plugin_json(self):
-        if self.original_ebooks == []:
-            return {}
+    def calibre_plugin_entry(self, locale_name):
+        # (label@locale, [legacy hash, ...]), for exports
+        return (u"%s@%s" % (self.label, locale_name),
+                self.build_legacy_hashes_list())
+
+
+# -------- Catalog
+class Catalog(object):
+    """ebooks & collections, indexed by every identifier we look them up by"""
+    def __init__(self):
+        self.ebooks = []
+        self.collections = []
+        # uuid/location/cdeKey: ebook, or [ebook, ...] (in insertion order)
+        # for the rare keys matching several ebooks
+        self.ebooks_index = {}
+        # uuid/label: first matching collection
+        self.collections_index = {}
+        # path hash: [ebook, ...], only built if a legacy hash needs it
+        self.path_hashes_index = None
+
+    def add_ebook(self, ebook):
+        self.ebooks.append(ebook)
+        if self.path_hashes_index is not None:
+            self._index_path_hash(ebook)
+        # an ebook is only listed once per key, even if, say, its uuid & cdeKey
+        # were to be identical
+        for key in set([ebook.uuid, ebook.location, ebook.cdekey]):
+            if key is None:
+                continue
+            indexed = self.ebooks_index.get(key)
+            if indexed is None:
+                self.ebooks_index[key] = ebook
+            elif isinstance(indexed, list):
+                indexed.append(ebook)
+            else:
+                self.ebooks_index[key] = [indexed, ebook]
+
+    def add_collection(self, collection):
+        self.collections.append(collection)
+        # setdefault: keep the first collection matching a given key, just
+        # like a front-to-back scan would.
+        # it would be very, very unlucky to have a collision
+        # between collection uuid & label...
+        self.collections_index.setdefault(collection.uuid, collection)
+        self.collections_index.setdefault(collection.label, collection)
+
+    def _rebuild_collections_index(self):
+        self.collections_index = {}
+        for collection in self.collections:
+            self.collections_index.setdefault(collection.uuid, collection)
+            self.collections_index.setdefault(collection.label, collection)
+
+    def clear_collections(self):
+        self.collections = []
+        self.collections_index = {}
+
+    def remove_empty_collections(self, original=False):
+        if original:
+            self.collections = [c for c in self.collections
+                                if len(c.original_ebooks) != 0]
         else:
-            return {
-                "%s@%s" % (self.label, locale.getdefaultlocale()[0]):
-                    {
-                        "items": self.build_legacy_hashes_list(),
-                        "lastAccess": int(time.time())
-                    }
-                }
-
-
-# it would be very, very unlucky to have a collision
-# between collection uuid & label...
-def find_collection(collections, collection_uuid_or_label):
-    for (i, collection) in enumerate(collections):
-        if collection.uuid == collection_uuid_or_label or\
-           collection.label == collection_uuid_or_label:
-            return i
-    return -1
-
-
-# same for uuid & location. Note that we add matching an uuid to a cdeKey in
-# order to handle the legacy json db schema.
-def find_ebook(ebooks, ebook_identifier, regexp=False):
-    if regexp:
-        pattern = re.compile(ebook_identifier.split("re:")[1], re.UNICODE)
-    hits = []
-    for (i, ebook) in enumerate(ebooks):
-        if not regexp and (ebook.uuid == ebook_identifier or
-                           ebook.location == ebook_identifier or
-                           ebook.cdekey == ebook_identifier):
-            hits.append(i)
-
-        if regexp and (pattern.search(ebook.uuid) or
-                       pattern.search(ebook.location) or
-                       pattern.search(str(ebook.cdekey))):
-            hits.append(i)
-    return hits
+            self.collections = [c for c in self.collections
+                                if len(c.ebooks) != 0]
+        self._rebuild_collections_index()
+
+    def dump(self, f, collections=None):
+        """Save the original state (as read from cc.db) to f.
+        collections: the ones read from cc.db, if self.collections changed
+        since."""
+        with gc_paused():
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            # nothing's pickled twice, don't keep track of what was
+            pickler.fast = True
+            pickler.dump(self._state(self.collections if collections is None
+                                     else collections))
+
+    @classmethod
+    def load(cls, f):
+        """The catalog saved to f by dump()"""
+        with gc_paused():
+            return cls._from_state(pickle.load(f))
+
+    def _state(self, existing_collections):
+        # Everything that points to ebooks & collections is saved as
+        # positions in their lists, so that _from_state() can rebuild it all
+        # without looking anything up. The ebooks index is saved as the
+        # positions of the ebooks each of their keys (uuid, location, cdeKey)
+        # is only used by.
+        collection_positions = dict(
+            (id(c), i) for (i, c) in enumerate(existing_collections))
+        ebook_positions = dict((id(e), i) for (i, e) in enumerate(self.ebooks))
+        indexed_by = ([], [], [])
+        shared_keys = {}
+        for (key, indexed) in self.ebooks_index.items():
+            if isinstance(indexed, list):
+                shared_keys[key] = [ebook_positions[id(e)] for e in indexed]
+            else:
+                field = 0 if key == indexed.uuid else \
+                    1 if key == indexed.location else 2
+                indexed_by[field].append(ebook_positions[id(indexed)])
+        collections = [(c.uuid, c.label, c.original_digest,
+                        [ebook_positions[id(e)] for e in c.original_ebooks])
+                       for c in existing_collections]
+        ebooks = [(e.uuid, e.location, e.cdekey, e.cdetype,
+                   e.collection_count, e.digest) for e in self.ebooks]
+        memberships = [(i, [collection_positions[id(c)]
+                            for c in e.original_collections])
+                       for (i, e) in enumerate(self.ebooks)
+                       if e.original_collections]
+        return collections, ebooks, memberships, indexed_by, shared_keys
+
+    @classmethod
+    def _from_state(cls, state):
+        collections, ebooks, memberships, indexed_by, shared_keys = state
+        catalog = cls()
+        for (uuid, label, digest, _) in collections:
+            collection = Collection(uuid, label)
+            collection.original_digest = digest
+            catalog.add_collection(collection)
+        catalog.ebooks = [Ebook(*ebook) for ebook in ebooks]
+        ebook_at = catalog.ebooks.__getitem__
+        for (field, positions) in enumerate(indexed_by):
+            catalog.ebooks_index.update(
+                (ebooks[i][field], ebook_at(i)) for i in positions)
+        for (key, positions) in shared_keys.items():
+            catalog.ebooks_index[key] = list(map(ebook_at, positions))
+        for (collection, (_, _, _, positions)) in zip(catalog.collections,
+                                                      collections):
+            collection.original_ebooks = OrderedSet.fromkeys(
+                map(ebook_at, positions))
+        collection_at = catalog.collections.__getitem__
+        for (i, positions) in memberships:
+            catalog.ebooks[i].original_collections = tuple(
+                map(collection_at, positions))
+        return catalog
+
+    def commit(self, collections):
+        """Once the commands were sent, make what was matched the original
+        state, as if freshly read from cc.db, and ready to be matched again.
+        collections: what cc.db was left with."""
+        for collection in self.collections:
+            collection.original_ebooks = collection.ebooks
+            collection.original_digest = collection.digest
+            if collection.is_new:
+                collection.uuid = str(collection.uuid)
+                collection.is_new = False
+        for ebook in self.ebooks:
+            if ebook.collections:
+                # what its update left in cc.db, if it needed one (see
+                # build_commands())
+                ebook.collection_count = len(ebook.collections)
+            ebook.original_collections = ()
+            ebook.collections = ()
+        self.clear_collections()
+        for collection in collections:
+            collection.ebooks = OrderedSet()
+            collection.digest = 0
+            for ebook in collection.original_ebooks:
+                ebook.add_collection(collection, True)
+            self.add_collection(collection)
+
+    def _index_path_hash(self, ebook):
+        if ebook.location:
+            self.path_hashes_index.setdefault(
+                path_hash(ebook.location), []).append(ebook)
+
+    def find_ebooks_by_path_hash(self, legacy_hash):
+        """ebooks whose full location has this md5"""
+        if self.path_hashes_index is None:
+            self.path_hashes_index = {}
+            for ebook in self.ebooks:
+                self._index_path_hash(ebook)
+        return list(self.path_hashes_index.get(legacy_hash.lower(), []))
+
+    def find_collection(self, collection_uuid_or_label):
+        return self.collections_index.get(collection_uuid_or_label)
+
+    # same for uuid & location. Note that we add matching an uuid to a cdeKey
+    # in order to handle the legacy json db schema.
+    def find_ebooks(self, ebook_identifier, regexp=False):
+        if not regexp:
+            indexed = self.ebooks_index.get(ebook_identifier)
+            if indexed is None:
+                return []
+            elif isinstance(indexed, list):
+                return list(indexed)
+            else:
+                return [indexed]
+
+        return RegexMatcher([ebook_identifier]).match(
+            self.ebooks)[ebook_identifier]
+
+
+# -------- RegEx matching
+REGEX_METACHARACTERS = u".^$*+?{}[]\\|()"
+REGEX_QUANTIFIERS = u"*+?{"
+
+
+def literal_prefix(pattern):
+    """Longest literal string any match of pattern has to start with."""
+    if u"|" in pattern:
+        # alternations could match something else entirely
+        return u""
+    if u"(?" in pattern:
+        # inline flags, like (?i) or (?x), change what the literal matches,
+        # and Python 2 takes them anywhere in the pattern
+        return u""
+    prefix = []
+    i = 0
+    if pattern.startswith(u"^"):
+        i = 1
+    while i < len(pattern):
+        char = pattern[i]
+        if char == u"\\":
+            # only escaped punctuation is a literal (\d, \w, \b... are not)
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                char = pattern[i + 1]
+                i += 1
+            else:
+                break
+        elif char in REGEX_METACHARACTERS:
+            break
+        i += 1
+        # a quantifier makes the previous character optional
+        if i < len(pattern) and pattern[i] in REGEX_QUANTIFIERS:
+            break
+        prefix.append(char)
+    return u"".join(prefix)
+
+
+class RegexMatcher(object):
+    """Match every "re:" identifier against all ebooks, in a single pass"""
+    def __init__(self, regexp_identifiers):
+        # (identifier, compiled pattern, literal prefix), compiled once
+        self.rules = []
+        for identifier in regexp_identifiers:
+            pattern = identifier.split("re:")[1]
+            self.rules.append((identifier,
+                               re.compile(pattern, re.UNICODE),
+                               literal_prefix(pattern)))
+
+    def match(self, ebooks):
+        hits = dict((identifier, []) for (identifier, _, _) in self.rules)
+        for ebook in ebooks:
+            fields = (ebook.uuid, ebook.location, str(ebook.cdekey))
+            for (identifier, pattern, prefix) in self.rules:
+                # cheap substring check before running the actual regex
+                if prefix and not (prefix in fields[0] or
+                                   prefix in fields[1] or
+                                   prefix in fields[2]):
+                    continue
+                if pattern.search(fields[0]) or \
+                   pattern.search(fields[1]) or \
+                   pattern.search(fields[2]):
+                    hits[identifier].append(ebook)
+        return hits
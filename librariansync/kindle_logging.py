@@ -1,23 +1,54 @@
 from __future__ import absolute_import
 
+import os
 import sys
+import time
+import codecs
 import syslog
 import six
-# Requires a Python snapshot circa 0.15.N-r15585
-from _fbink import ffi, lib as fbink
+from collections import OrderedDict
 
 # ------- Logging & user feedback (from the K5 Fonts Hack)
 
 LIBRARIAN_SYNC = "LibrarianSync"
 
-# Setup FBInk to our liking...
-FBINK_CFG = ffi.new("FBInkConfig *")
-FBINK_CFG.is_quiet = True
-FBINK_CFG.is_rpadded = True
-FBINK_CFG.row = -6
+# FBInk is only loaded & initialized the first time we have something to show.
+# In headless mode (or when it's not available, e.g., when benchmarking),
+# we never touch the framebuffer, and only log to syslog.
+ffi = None
+fbink = None
+FBINK_CFG = None
+FBINK_UNAVAILABLE = False
+HEADLESS = False
 
-# And initialize it
-fbink.fbink_init(fbink.FBFD_AUTO, FBINK_CFG)
+
+def set_headless(headless=True):
+    global HEADLESS
+    HEADLESS = headless
+
+
+def init_fbink():
+    global ffi, fbink, FBINK_CFG, FBINK_UNAVAILABLE
+    if HEADLESS or FBINK_UNAVAILABLE:
+        return False
+    if fbink is not None:
+        return True
+    try:
+        # Requires a Python snapshot circa 0.15.N-r15585
+        from _fbink import ffi, lib as fbink
+    except ImportError:
+        FBINK_UNAVAILABLE = True
+        return False
+
+    # Setup FBInk to our liking...
+    FBINK_CFG = ffi.new("FBInkConfig *")
+    FBINK_CFG.is_quiet = True
+    FBINK_CFG.is_rpadded = True
+    FBINK_CFG.row = -6
+
+    # And initialize it
+    fbink.fbink_init(fbink.FBFD_AUTO, FBINK_CFG)
+    return True
 
 
 # Pilfered from KindleUnpack, with minor tweaks ;).
@@ -49,10 +80,16 @@ else:
     def bstr(s):
         return str(s)
 
+SYSLOG_OPENED = False
+
+
 def log(program, function, msg, level="I", display=True):
-    global LAST_SHOWN
-    # open syslog
-    syslog.openlog("system: %s %s:%s:" % (level, program, function))
+    global SYSLOG_OPENED
+    # open syslog, once: the level, program & function go in the message
+    # instead of the ident, which gets us the exact same log lines.
+    if not SYSLOG_OPENED:
+        syslog.openlog("system")
+        SYSLOG_OPENED = True
     # set priority
     priority = syslog.LOG_INFO
     if level == "E":
@@ -61,12 +98,16 @@ def log(program, function, msg, level="I", display=True):
         priority = syslog.LOG_WARNING
     priority |= syslog.LOG_LOCAL4
     # write to syslog
-    syslog.syslog(priority, msg)
+    line = "%s %s:%s:: %s" % (level, program, function, msg)
+    if not six.PY3 and isinstance(line, six.text_type):
+        # Python 2's syslog wants bytes
+        line = line.encode("utf-8")
+    syslog.syslog(priority, line)
     #
     # NOTE: showlog / showlog -f to check the logs
     #
 
-    if display:
+    if display and init_fbink():
         # NOTE: FBInk takes a const char*, that's explicitly bytes in Python 3!
         program_display = " %s: " % program
         tag = ""
@@ -77,3 +118,76 @@ def log(program, function, msg, level="I", display=True):
         # print using FBInk (via cFFI)
         msg_as_bytes = bstr("{}\n{} {}".format(program_display, tag, message))
         fbink.fbink_print(fbink.FBFD_AUTO, msg_as_bytes, FBINK_CFG)
+
+
+# ------- Per-item warnings
+# Instead of logging them one by one, collect them, log a summary, and list
+# them all in a file, once at the end.
+# (program, function, what): [item, ...]
+AGGREGATED_WARNINGS = OrderedDict()
+# next to exported_collections.json, in the extensions folder
+UNMATCHED_SUMMARY = u"../librariansync_unmatched.txt"
+# how many items are quoted in the syslog summary
+SUMMARY_EXAMPLES = 3
+
+
+def log_aggregated(program, function, what, item):
+    AGGREGATED_WARNINGS.setdefault((program, function, what), []).append(item)
+
+
+def flush_aggregated(summary_file=None):
+    if summary_file is None:
+        summary_file = UNMATCHED_SUMMARY
+    if not AGGREGATED_WARNINGS:
+        # don't leave the previous run's summary around
+        if os.path.exists(summary_file):
+            os.remove(summary_file)
+        return
+
+    for ((program, function, what), items) in AGGREGATED_WARNINGS.items():
+        examples = u", ".join(unicode_str(item)
+                              for item in items[:SUMMARY_EXAMPLES])
+        if len(items) > SUMMARY_EXAMPLES:
+            examples += u", ..."
+        log(program, function, u"%s: %d entries (%s)"
+            % (what, len(items), examples), "W", display=False)
+    try:
+        with codecs.open(summary_file, "w", "utf8") as f:
+            for ((program, function, what), items) in \
+                    AGGREGATED_WARNINGS.items():
+                f.write(u"# %s (%s, %d entries)\n"
+                        % (what, function, len(items)))
+                for item in items:
+                    f.write(u"%s\n" % unicode_str(item))
+        log(LIBRARIAN_SYNC, "summary",
+            "%d entries couldn't be used, see %s."
+            % (sum(len(items) for items in AGGREGATED_WARNINGS.values()),
+               summary_file), "W")
+    except (IOError, OSError) as e:
+        log(LIBRARIAN_SYNC, "summary",
+            "Couldn't write %s (%s)" % (summary_file, e), "W", display=False)
+    AGGREGATED_WARNINGS.clear()
+
+
+# ------- Progress
+# Every redraw is an e-ink refresh, so don't redraw more often than that.
+PROGRESS_INTERVAL = 0.3
+PROGRESS_WIDTH = 20
+LAST_PROGRESS = 0
+
+
+def progress(program, msg, current, total):
+    global LAST_PROGRESS
+    now = time.time()
+    # always show when we're done
+    if current < total and now - LAST_PROGRESS < PROGRESS_INTERVAL:
+        return
+    if not init_fbink():
+        return
+    LAST_PROGRESS = now
+
+    done = PROGRESS_WIDTH * current // max(total, 1)
+    msg_as_bytes = bstr(u" {}: \n {} [{}{}] {}/{}".format(
+        program, unicode_str(msg), u"#" * done,
+        u" " * (PROGRESS_WIDTH - done), current, total))
+    fbink.fbink_print(fbink.FBFD_AUTO, msg_as_bytes, FBINK_CFG)
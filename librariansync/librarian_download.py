@@ -14,10 +14,17 @@ import requests
 import os
 import time
 import sys
-import sqlite3
+import argparse
+import hashlib
+import json
+import threading
+import six
 import six.moves.configparser
-from kindle_logging import log, LIBRARIAN_SYNC
-from generate_collections import update_cc_db, KINDLE_DB_PATH
+from six.moves import queue
+from kindle_logging import log, flush_aggregated, progress, set_headless
+from kindle_logging import LIBRARIAN_SYNC
+from generate_collections import update_cc_db, open_cc_db
+from kindle_contents import MTIME_RESOLUTION
 
 ebook_mimetypes = ['application/epub+zip', 'application/x-mobipocket-ebook']
 
@@ -25,75 +32,409 @@ DESTINATION_DIR = u'/mnt/us/documents/library/'
 COLLECTIONS_DIR = u'/mnt/us/extensions'
 SERVER_HTTP = u"http://%s:%s/"
 
+# number of files downloaded at the same time
+DOWNLOAD_WORKERS = 4
+# big chunks & write buffers: fewer syscalls, fewer writes to the userstore
+CHUNK_SIZE = 256 * 1024
+# (connect, read): an unreachable address fails fast
+CONNECT_TIMEOUT = 3
+TIMEOUT = (CONNECT_TIMEOUT, 30)
+# endpoints that didn't answer, skipped by later runs for a while
+FAILED_ENDPOINTS = u"librarian_download_failed.json"
+FAILED_ENDPOINT_TTL = 600
+# what we know about every downloaded ebook (size, mtime, server validators,
+# md5), so that unchanged ones aren't downloaded again.
+DOWNLOAD_MANIFEST = u"librarian_download_manifest.json"
+MANIFEST_VERSION = 1
+# don't rewrite the manifest more often than that while downloading
+MANIFEST_SAVE_INTERVAL = 10
+
 
 def url(ip, port, arg):
     return os.path.join(SERVER_HTTP % (ip, port), arg)
 
 
-def download_file(ip, port, url):
-    r = requests.get(url, stream=True)
+def make_session():
+    # one pool of kept-alive connections, big enough for all the workers
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=DOWNLOAD_WORKERS))
+    return session
 
-    if r.headers['content-type'] in ebook_mimetypes or\
-       r.headers['content-type'] == "application/json":
 
-        filename = url.split(SERVER_HTTP % (ip, port))[1]
-        if filename == "collections.json":
-            local_filename = os.path.join(COLLECTIONS_DIR, filename)
-        else:
-            local_filename = os.path.join(DESTINATION_DIR, filename)
+class DownloadManifest(object):
+    """{filename: entry}, shared by the download workers"""
+    def __init__(self, manifest_file=None):
+        self.manifest_file = manifest_file or DOWNLOAD_MANIFEST
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        try:
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.entries = manifest["files"]
+        except (IOError, OSError, ValueError, KeyError, AttributeError):
+            pass
+
+    def get(self, filename):
+        with self.lock:
+            return self.entries.get(filename)
+
+    def set(self, filename, entry):
+        with self.lock:
+            self.entries[filename] = entry
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp_file = self.manifest_file + u".tmp"
+            try:
+                with open(tmp_file, "w") as f:
+                    json.dump({"version": MANIFEST_VERSION,
+                               "files": self.entries}, f)
+                os.rename(tmp_file, self.manifest_file)
+                self.dirty = False
+            except (IOError, OSError) as e:
+                log(LIBRARIAN_SYNC, "manifest",
+                    "Couldn't save the download manifest (%s)" % e, "W",
+                    display=False)
+
+
+def file_md5(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            md5.update(chunk)
+    return md5
+
+
+def is_intact(entry, local_filename):
+    # the file is still the one we downloaded
+    if entry.get("partial"):
+        return False
+    try:
+        st = os.stat(local_filename)
+    except OSError:
+        return False
+    if st.st_size != entry.get("size"):
+        return False
+    # FAT only keeps mtimes to the 2s, which older kernels only apply once
+    # the userstore is remounted
+    if entry.get("mtime") is not None and \
+       abs(int(st.st_mtime) - entry["mtime"]) <= MTIME_RESOLUTION:
+        return True
+    # touched since, but maybe not changed: only its contents can tell
+    if entry.get("md5") is None:
+        return False
+    try:
+        return file_md5(local_filename).hexdigest() == entry["md5"]
+    except (IOError, OSError):
+        return False
+
+
+def conditional_headers(entry, local_filename, intact):
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get("partial"):
+        # resume, but only if the server copy is the one we started with
+        validator = entry.get("etag") or entry.get("last_modified")
+        tmp_filename = local_filename + u".part"
+        if validator and os.path.exists(tmp_filename):
+            headers["Range"] = "bytes=%d-" % os.path.getsize(tmp_filename)
+            headers["If-Range"] = validator
+    elif intact:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def is_unchanged(entry, intact, r):
+    # for servers ignoring conditional requests
+    if not intact:
+        return False
+    if r.headers.get("etag") or entry.get("etag"):
+        return r.headers.get("etag") == entry.get("etag")
+    if r.headers.get("last-modified") or entry.get("last_modified"):
+        return r.headers.get("last-modified") == entry.get("last_modified")
+    # no validators at all, the size will have to do
+    return r.headers.get("content-length") == str(entry.get("size"))
+
+
+def download_file(session, ip, port, url, manifest=None):
+    filename = url.split(SERVER_HTTP % (ip, port))[1]
+    if filename == "collections.json":
+        local_filename = os.path.join(COLLECTIONS_DIR, filename)
+    else:
+        local_filename = os.path.join(DESTINATION_DIR, filename)
+    entry = None
+    intact = False
+    headers = {}
+    if manifest is not None:
+        entry = manifest.get(filename)
+        intact = entry is not None and is_intact(entry, local_filename)
+        headers = conditional_headers(entry, local_filename, intact)
+
+    r = session.get(url, stream=True, timeout=TIMEOUT, headers=headers)
+    content_type = r.headers.get('content-type')
+    if r.status_code == requests.codes.requested_range_not_satisfiable:
+        # whatever is in the .part file is no good, start over
+        r.close()
+        os.remove(local_filename + u".part")
+        return download_file(session, ip, port, url, manifest)
+
+    if r.status_code == requests.codes.not_modified or \
+       (r.status_code == requests.codes.ok and
+            is_unchanged(entry, intact, r)):
+        # don't download the body
+        r.close()
+        mtime = int(os.stat(local_filename).st_mtime)
+        if mtime != entry.get("mtime"):
+            # only checked its md5 (or close enough), remember its mtime now
+            manifest.set(filename, dict(entry, mtime=mtime))
+        return requests.codes.not_modified, content_type, local_filename
+    elif content_type in ebook_mimetypes or \
+            content_type == "application/json":
+
         if not os.path.exists(os.path.dirname(local_filename)):
             log(LIBRARIAN_SYNC, "download_file",
-                "Creating %s" % os.path.dirname(local_filename))
-            os.makedirs(os.path.dirname(local_filename))
-        with open(local_filename, 'wb') as f:
-            for chunk in r.iter_content(chunk_size=1024):
+                "Creating %s" % os.path.dirname(local_filename),
+                display=False)
+            try:
+                os.makedirs(os.path.dirname(local_filename))
+            except OSError:
+                # another worker beat us to it
+                if not os.path.isdir(os.path.dirname(local_filename)):
+                    raise
+        # download to a temporary file, so that an interrupted download
+        # never leaves a truncated file behind, and can be resumed
+        tmp_filename = local_filename + u".part"
+        if r.status_code == requests.codes.partial_content:
+            mode = 'ab'
+            md5 = file_md5(tmp_filename)
+        else:
+            mode = 'wb'
+            md5 = hashlib.md5()
+        validators = {"etag": r.headers.get("etag"),
+                      "last_modified": r.headers.get("last-modified")}
+        if manifest is not None:
+            manifest.set(filename, dict(validators, partial=True))
+        with open(tmp_filename, mode, CHUNK_SIZE) as f:
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
                 if chunk:  # filter out keep-alive new chunks
                     f.write(chunk)
-                    f.flush()
-        return r.status_code, r.headers['content-type'], local_filename
-    elif r.headers['content-type'] == "text/plain":
+                    md5.update(chunk)
+        os.rename(tmp_filename, local_filename)
+        if manifest is not None:
+            st = os.stat(local_filename)
+            manifest.set(filename, dict(validators, size=st.st_size,
+                                        mtime=int(st.st_mtime),
+                                        md5=md5.hexdigest()))
+        return r.status_code, content_type, local_filename
+    elif content_type == "text/plain":
         r.encoding = "utf8"
-        return r.status_code, r.headers['content-type'], r.text
+        return r.status_code, content_type, r.text
     else:
-        return r.status_code, r.headers['content-type'], None
+        return r.status_code, content_type, None
 
 
-def download_all_served_ebooks(ip, port):
-    # ask for available ebooks
-    code, mimetype, result = download_file(ip, port, url(ip, port, "index"))
-    if code == requests.codes.ok and mimetype == "text/plain":
-        epubs = result.split("|")
-        # download them all
-        for epub in epubs:
-            log(LIBRARIAN_SYNC, "download",
-                "D/L: %s." % os.path.basename(epub))
-            code, mimetype, result = download_file(ip, port,
-                                                   url(ip, port, epub))
+def download_ebooks(session, ip, port, epubs, manifest):
+    pending = queue.Queue()
+    for epub in epubs:
+        pending.put(epub)
+    results = queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                epub = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                results.put((epub, download_file(session, ip, port,
+                                                 url(ip, port, epub),
+                                                 manifest), None))
+            except (requests.exceptions.RequestException,
+                    IOError, OSError) as e:
+                results.put((epub, e, None))
+            except Exception:
+                # anything else is a bug: hand it over to the main thread,
+                # which would otherwise wait for this result forever
+                results.put((epub, None, sys.exc_info()))
+                return
+
+    workers = [threading.Thread(target=worker)
+               for _ in range(min(DOWNLOAD_WORKERS, len(epubs)))]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    start = time.time()
+    last_save = start
+    downloaded = 0
+    resumed = 0
+    unchanged = 0
+    downloaded_bytes = 0
+    try:
+        for i in range(len(epubs)):
+            epub, result, error = results.get()
+            if error is not None:
+                six.reraise(*error)
+            progress(LIBRARIAN_SYNC, "Downloading", i + 1, len(epubs))
+            if time.time() - last_save > MANIFEST_SAVE_INTERVAL:
+                manifest.save()
+                last_save = time.time()
+            if isinstance(result, Exception):
+                log(LIBRARIAN_SYNC, "download",
+                    "Failed to download %s (%s)." % (epub, result), "W",
+                    display=False)
+                continue
+            code, mimetype, local_filename = result
             if code == requests.codes.not_found:
                 log(LIBRARIAN_SYNC, "download", "%s not found." % epub, "W")
-            elif code == requests.codes.ok:
+            elif code == requests.codes.not_modified:
+                unchanged += 1
+            elif code in (requests.codes.ok, requests.codes.partial_content):
                 if mimetype not in ebook_mimetypes:
-                    raise Exception("what?")
+                    log(LIBRARIAN_SYNC, "download",
+                        "Unexpected content type for %s: %s."
+                        % (epub, mimetype), "W", display=False)
                 else:
+                    downloaded += 1
+                    if code == requests.codes.partial_content:
+                        resumed += 1
+                    downloaded_bytes += os.path.getsize(local_filename)
                     log(LIBRARIAN_SYNC, "download",
                         "Downloaded: %s." % os.path.basename(epub),
                         display=False)
-        # ask for the associated collections
-        code, mimetype, result = download_file(ip, port,
-                                               url(ip, port,
-                                                   "collections.json"))
-        # shutdown the server, all done
-        code, mimetype, result = download_file(ip, port,
-                                               url(ip, port,
-                                                   "LibrarianServer::shutdown")
-                                               )
-        if code == requests.codes.ok and mimetype == "text/plain":
-            log(LIBRARIAN_SYNC, "shutdown", result)
-    else:
+        for w in workers:
+            w.join()
+    finally:
+        # even if interrupted, so that partial downloads can be resumed
+        manifest.save()
+
+    elapsed = max(time.time() - start, 0.001)
+    log(LIBRARIAN_SYNC, "download",
+        "Downloaded %d/%d files (%d resumed, %d unchanged, %.01fMB) in "
+        "%.02fs (%.02fMB/s)."
+        % (downloaded, len(epubs), resumed, unchanged,
+           downloaded_bytes / 1048576.0, elapsed,
+           downloaded_bytes / 1048576.0 / elapsed))
+
+
+def load_failed_endpoints():
+    try:
+        with open(FAILED_ENDPOINTS, "r") as f:
+            failed = json.load(f)
+        now = time.time()
+        return dict((endpoint, timestamp)
+                    for (endpoint, timestamp) in failed.items()
+                    if 0 <= now - timestamp < FAILED_ENDPOINT_TTL)
+    except (IOError, OSError, ValueError, AttributeError):
+        return {}
+
+
+def save_failed_endpoints(failed):
+    try:
+        with open(FAILED_ENDPOINTS, "w") as f:
+            json.dump(failed, f)
+    except (IOError, OSError) as e:
+        log(LIBRARIAN_SYNC, "connect",
+            "Couldn't save failed endpoints (%s)" % e, "W", display=False)
+
+
+def find_server(ips, port):
+    """Ask all endpoints for the index at the same time.
+
+    Returns (session, ip, epubs) for the first one that answers,
+    or (None, None, None)."""
+    failed = load_failed_endpoints()
+    candidates = [ip for ip in ips if "%s:%s" % (ip, port) not in failed]
+    if not candidates:
+        # they all failed recently, try again anyway
+        candidates = ips
+    elif len(candidates) < len(ips):
+        log(LIBRARIAN_SYNC, "connect",
+            "Skipping recently unreachable: %s"
+            % ", ".join(ip for ip in ips if ip not in candidates),
+            display=False)
+
+    answers = queue.Queue()
+
+    def probe(ip):
+        # one session per endpoint, the winner's is kept for the downloads
+        session = make_session()
+        try:
+            code, mimetype, result = download_file(session, ip, port,
+                                                   url(ip, port, "index"))
+            if code == requests.codes.ok and mimetype == "text/plain":
+                answers.put((ip, session, result))
+                return
+            error = "HTTP %d" % code
+        except requests.exceptions.RequestException as e:
+            error = e
+        session.close()
+        answers.put((ip, None, error))
+
+    for ip in candidates:
+        t = threading.Thread(target=probe, args=(ip,))
+        t.daemon = True
+        t.start()
+
+    winner = (None, None, None)
+    for _ in candidates:
+        ip, session, result = answers.get()
+        if session is None:
+            log(LIBRARIAN_SYNC, "connect", "%s : %s" % (ip, result),
+                display=False)
+            failed["%s:%s" % (ip, port)] = time.time()
+            continue
+        failed.pop("%s:%s" % (ip, port), None)
+        winner = (session, ip, [epub for epub in result.split("|") if epub])
+        # don't wait for the others
+        break
+    save_failed_endpoints(failed)
+    return winner
+
+
+def download_all_served_ebooks(ips, port):
+    # ask for available ebooks
+    session, ip, epubs = find_server(ips, port)
+    if session is None:
         log(LIBRARIAN_SYNC, "retrieve_index", "Could not retrieve index.")
+        return False
+    log(LIBRARIAN_SYNC, "connect", "Connected to %s." % ip, display=False)
+    # download them all
+    download_ebooks(session, ip, port, epubs, DownloadManifest())
+    # ask for the associated collections
+    code, mimetype, result = download_file(session, ip, port,
+                                           url(ip, port, "collections.json"))
+    # shutdown the server, all done
+    code, mimetype, result = download_file(session, ip, port,
+                                           url(ip, port,
+                                               "LibrarianServer::shutdown"))
+    if code == requests.codes.ok and mimetype == "text/plain":
+        log(LIBRARIAN_SYNC, "shutdown", result)
+    session.close()
+    return True
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Librarian Sync. Download '
+                                     'ebooks served by librarian.')
+    parser.add_argument('--headless', dest='headless',
+                        action='store_true', default=False,
+                        help='never display anything on screen, '
+                        'only log to syslog.')
+    args = parser.parse_args()
+    if args.headless:
+        set_headless()
+
     start = time.time()
     log(LIBRARIAN_SYNC, "download", "Starting...")
     try:
@@ -104,29 +445,20 @@ if __name__ == "__main__":
     except:
         log(LIBRARIAN_SYNC, "download",
             "Missing or incorrect configuration file.")
-    failed = 0
-    for ip in IPs:
-        try:
-            download_all_served_ebooks(ip, port)
-        except requests.packages.urllib3.exceptions.ProtocolError as e:
-            err, code = e
-            failed += 1
-            log(LIBRARIAN_SYNC, "connect", "%s : %s" % (ip, code),
-                display=False)
-
-    if failed == len(IPs):
+    if not download_all_served_ebooks(IPs, port):
         log(LIBRARIAN_SYNC, "connect",
             "Impossible to connect to librarian.", "E")
     else:
         # update collections
         try:
-            with sqlite3.connect(KINDLE_DB_PATH) as cc_db:
+            with open_cc_db() as cc_db:
                 c = cc_db.cursor()
                 log(LIBRARIAN_SYNC, "update", "Updating collections...")
                 update_cc_db(c, complete_rebuild=False, source="librarian")
         except:
             log(LIBRARIAN_SYNC, "main",
                 "Something went wrong while updating collections.", "E")
+        flush_aggregated()
 
         log(LIBRARIAN_SYNC, "download",
             "Done in %.02fs." % (time.time()-start))
@@ -0,0 +1,104 @@
+from __future__ import absolute_import
+
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from kindle_logging import log, LIBRARIAN_SYNC
+
+# next to exported_collections.json, in the extensions folder
+PROFILE_REPORT = u"../librariansync_profile.json"
+
+
+class Profiler(object):
+    """Per-phase timings & counters, only recorded when enabled"""
+    def __init__(self):
+        self.enabled = False
+        self.start = time.time()
+        # phase: [total time, number of calls]
+        self.phases = OrderedDict()
+        # "thread: phase": [total time, number of calls], for the phases
+        # timed on other threads (they overlap the main thread's)
+        self.background_phases = OrderedDict()
+        self.counters = OrderedDict()
+        # the sender thread records its phases & counters too
+        self.lock = threading.Lock()
+        # we're imported from the main thread
+        self.main_thread = threading.current_thread()
+
+    def enable(self):
+        self.enabled = True
+        self.start = time.time()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            thread = threading.current_thread()
+            with self.lock:
+                if thread is self.main_thread:
+                    timing = self.phases.setdefault(name, [0.0, 0])
+                else:
+                    timing = self.background_phases.setdefault(
+                        "%s: %s" % (thread.name, name), [0.0, 0])
+                timing[0] += elapsed
+                timing[1] += 1
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def report(self, report_file=None, **details):
+        if not self.enabled:
+            return
+        if report_file is None:
+            report_file = PROFILE_REPORT
+        total = time.time() - self.start
+        for (name, (timing, calls)) in self.phases.items():
+            log(LIBRARIAN_SYNC, "profile",
+                "%s: %.03fs (%d calls, %.01f%%)"
+                % (name, timing, calls, 100 * timing / max(total, 1e-6)),
+                display=False)
+        for (name, (timing, calls)) in self.background_phases.items():
+            log(LIBRARIAN_SYNC, "profile",
+                "%s: %.03fs (%d calls, %.01f%%, in the background)"
+                % (name, timing, calls, 100 * timing / max(total, 1e-6)),
+                display=False)
+        for (name, value) in self.counters.items():
+            log(LIBRARIAN_SYNC, "profile", "%s: %d" % (name, value),
+                display=False)
+
+        report = OrderedDict()
+        report["timestamp"] = int(self.start)
+        report["python"] = sys.version.split()[0]
+        report.update(details)
+        report["total"] = total
+        report["phases"] = OrderedDict(
+            (name, {"time": timing, "calls": calls})
+            for (name, (timing, calls)) in self.phases.items())
+        report["background_phases"] = OrderedDict(
+            (name, {"time": timing, "calls": calls})
+            for (name, (timing, calls)) in self.background_phases.items())
+        report["counters"] = self.counters
+        try:
+            with open(report_file, "w") as f:
+                json.dump(report, f, indent=2)
+        except (IOError, OSError) as e:
+            log(LIBRARIAN_SYNC, "profile",
+                "Couldn't write profile report (%s)" % e, "W", display=False)
+
+
+# The one used by everything
+PROFILER = Profiler()
+phase = PROFILER.phase
+count = PROFILER.count
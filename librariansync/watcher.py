@@ -0,0 +1,234 @@
+from __future__ import absolute_import
+
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import six
+
+from kindle_logging import log, LIBRARIAN_SYNC
+
+# ------- inotify, straight from libc (no pyinotify on a Kindle)
+# from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_MASK_ADD = 0x20000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# watched files are watched through their folder, since they're usually
+# replaced rather than rewritten
+FILE_CHANGES = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE
+# files written to in place (e.g., cc.db) are watched themselves for writes,
+# their folder only tells us when they come and go: writes to anything else
+# in there (/var/local is busy) don't wake us up
+IN_PLACE_FILE_CHANGES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+FILE_WRITES = IN_MODIFY | IN_CLOSE_WRITE
+# no IN_MODIFY in trees: IN_CLOSE_WRITE once a file is written is enough
+TREE_CHANGES = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+TREE_LOST = IN_UNMOUNT | IN_DELETE_SELF | IN_MOVE_SELF
+
+# struct inotify_event, followed by a NUL padded name
+EVENT = struct.Struct("iIII")
+EVENTS_BUFFER = 64 * 1024
+
+# changes are reported once nothing happened for that long (e.g., a whole
+# batch of ebooks being copied)...
+DEBOUNCE = 5.0
+# ...or that long after the first change, whichever comes first
+MAX_DELAY = 60.0
+# how often we look for a tree that's gone (e.g., /mnt/us, while exported
+# over USB) to come back
+REMOUNT_POLL = 30.0
+
+
+def fs_path(path):
+    if isinstance(path, six.text_type):
+        return path.encode(sys.getfilesystemencoding() or "utf-8")
+    return path
+
+
+class Watcher(object):
+    """Watches files & folder trees, and reports which of them changed,
+    once a burst of changes is over. Blocks (no CPU) in between."""
+    def __init__(self, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.debounce = debounce
+        self.max_delay = max_delay
+        # wd: {file name: tag}
+        self.files = {}
+        # folder wd: {file name: path}, of the files written to in place
+        self.in_place_files = {}
+        # wd: tag, of the files watched themselves
+        self.written_files = {}
+        # wd: (tag, folder path), for every folder of the watched trees
+        self.folders = {}
+        # tag: (root, prune, relevant)
+        self.trees = {}
+        # tags of the trees whose root is gone
+        self.lost = set()
+
+    def close(self):
+        os.close(self.fd)
+
+    def _watch(self, path, mask):
+        wd = self.inotify_add_watch(self.fd, fs_path(path),
+                                    mask | IN_ONLYDIR | IN_MASK_ADD)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        return wd
+
+    def watch_file(self, path, tag, in_place=False):
+        """in_place: the file is written to, rather than replaced (e.g., a
+        database)."""
+        folder, name = os.path.split(os.path.abspath(path))
+        wd = self._watch(folder,
+                         IN_PLACE_FILE_CHANGES if in_place else FILE_CHANGES)
+        self.files.setdefault(wd, {})[name] = tag
+        if in_place:
+            self.in_place_files.setdefault(wd, {})[name] = path
+            self._watch_written_file(path, tag)
+
+    def _watch_written_file(self, path, tag):
+        wd = self.inotify_add_watch(self.fd, fs_path(path),
+                                    FILE_WRITES | IN_MASK_ADD)
+        # if it's not there (yet), its folder tells us when it shows up
+        if wd >= 0:
+            self.written_files[wd] = tag
+
+    def watch_tree(self, root, tag, prune=None, relevant=None):
+        """prune(folder name): don't watch that folder.
+        relevant(name, is_dir): only those changes are reported."""
+        self.trees[tag] = (root, prune, relevant)
+        self._watch_subtree(tag, root)
+
+    def _watch_subtree(self, tag, path):
+        root, prune, relevant = self.trees[tag]
+        if not os.path.isdir(root):
+            self.lost.add(tag)
+            return
+        for (folder, subdirs, _) in os.walk(path):
+            if prune is not None:
+                subdirs[:] = [d for d in subdirs if not prune(d)]
+            try:
+                self.folders[self._watch(folder, TREE_CHANGES)] = (tag,
+                                                                   folder)
+            except OSError as e:
+                # e.g., out of watches (fs.inotify.max_user_watches)
+                log(LIBRARIAN_SYNC, "watch",
+                    "Couldn't watch %s (%s)" % (folder, e), "W",
+                    display=False)
+        self.lost.discard(tag)
+
+    def _read_events(self):
+        changed = set()
+        data = os.read(self.fd, EVENTS_BUFFER)
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(
+                "utf-8", "replace")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # we missed some, assume everything changed
+                changed.update(set(tag for names in self.files.values()
+                                   for tag in names.values()))
+                changed.update(self.trees)
+                continue
+            if wd in self.written_files:
+                if mask & IN_IGNORED:
+                    # it's gone
+                    del self.written_files[wd]
+                else:
+                    changed.add(self.written_files[wd])
+                continue
+            if wd in self.files and name in self.files[wd]:
+                changed.add(self.files[wd][name])
+                if mask & (IN_CREATE | IN_MOVED_TO) and \
+                   name in self.in_place_files.get(wd, {}):
+                    self._watch_written_file(self.in_place_files[wd][name],
+                                             self.files[wd][name])
+            if wd not in self.folders:
+                continue
+            tag, folder = self.folders[wd]
+            root, prune, relevant = self.trees[tag]
+            if mask & IN_IGNORED:
+                # the watch is gone, along with its folder
+                del self.folders[wd]
+                if folder == root:
+                    self.lost.add(tag)
+                continue
+            if mask & TREE_LOST and folder == root:
+                self.lost.add(tag)
+                changed.add(tag)
+                continue
+            is_dir = bool(mask & IN_ISDIR)
+            if is_dir and prune is not None and prune(name):
+                continue
+            if is_dir and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_subtree(tag, os.path.join(folder, name))
+            if name and (relevant is None or relevant(name, is_dir)):
+                changed.add(tag)
+        return changed
+
+    def _poll_lost_trees(self):
+        changed = set()
+        for tag in list(self.lost):
+            root = self.trees[tag][0]
+            if os.path.isdir(root):
+                log(LIBRARIAN_SYNC, "watch", "%s is back." % root,
+                    display=False)
+                self._watch_subtree(tag, root)
+                # no idea what happened in the meantime
+                changed.add(tag)
+        return changed
+
+    def wait(self):
+        """Block until something changed, and things settled down.
+        Returns the tags of what changed."""
+        changed = set()
+        first_change = None
+        while True:
+            if changed:
+                timeout = min(self.debounce,
+                              first_change + self.max_delay - time.time())
+                if timeout <= 0:
+                    return changed
+            elif self.lost:
+                timeout = REMOUNT_POLL
+            else:
+                # nothing to do until something happens
+                timeout = None
+            readable = select.select([self.fd], [], [], timeout)[0]
+            if readable:
+                new_changes = self._read_events()
+            else:
+                if changed:
+                    # quiet for long enough
+                    return changed
+                new_changes = set()
+            new_changes |= self._poll_lost_trees()
+            if new_changes and not changed:
+                first_change = time.time()
+            changed |= new_changes
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This script benchmarks LibrarianSync off-device.
+
+For each library size, it generates a synthetic library (see
+make_synthetic_library.py), then times every generate_collections.py mode
+against it, each in a fresh process, with fake_cc_service.py standing in for
+the Kindle's content catalog service. Every path LibrarianSync would use on a
+Kindle is pointed somewhere inside the work folder.
+
+Results (wall-clock time and peak RSS per size & mode) can be saved as a
+baseline, and later runs are compared against it: any mode that got slower
+or bigger than the tolerance allows is reported, and the script exits with
+an error.
+With --max-rss, LibrarianSync runs with that --max-memory ceiling, and any
+mode whose peak RSS goes over it is an error too.
+
+NOTE: the child process part of this script (--child) runs with the
+interpreter given by --python, which may be Python 2.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+LIBRARIANSYNC_DIR = os.path.join(os.path.dirname(TOOLS_DIR), "librariansync")
+BASELINE = os.path.join(TOOLS_DIR, "benchmark_baseline.json")
+
+SIZES = [1000, 10000, 50000]
+# "startup" only imports LibrarianSync's modules, and exits
+MODES = ["startup", "--rebuild", "--update", "--folders", "--rebuild-calibre",
+         "--update-calibre", "--export", "--delete"]
+# below that, differences are just noise
+MIN_TIME_DELTA = 0.1
+MIN_RSS_DELTA_KB = 1024
+PRETTYVERSION = "Kindle 5.12.2 (4058920073) Fake firmware version\n"
+
+
+# -------- Child: runs one mode, in its own process
+def run_child(config):
+    sys.path.insert(0, LIBRARIANSYNC_DIR)
+    os.chdir(config["run_dir"])
+    start = time.time()
+    import kindle_logging
+    import kindle_contents
+    import cc_update
+    import profiling
+    import generate_collections
+    import_time = time.time() - start
+
+    generate_collections.KINDLE_DB_PATH = config["cc_db"]
+    generate_collections.TAGS = config["librarian_json"]
+    generate_collections.CALIBRE_PLUGIN_FILE = config["calibre_plugin_json"]
+    generate_collections.EXPORT = config["export"]
+    generate_collections.KINDLE_EBOOKS_ROOT = config["documents"]
+    kindle_contents.KINDLE_EBOOKS_ROOT = config["documents"]
+    kindle_contents.FOLDERS_SNAPSHOT = config["folders_snapshot"]
+    cc_update.CC_CHANGE_URL = config["change_url"]
+    cc_update.PRETTYVERSION_FILE = config["prettyversion"]
+    cc_update.SESSION_TOKEN_FILE = config["session_token"]
+    kindle_logging.UNMATCHED_SUMMARY = config["unmatched_summary"]
+    args = [config["mode"], "--headless"]
+    if config["max_memory"]:
+        args += ["--max-memory", str(config["max_memory"])]
+    if config["profile_report"]:
+        profiling.PROFILE_REPORT = config["profile_report"]
+        args.append("--profile")
+
+    if config["mode"] == "startup":
+        ok = True
+    else:
+        ok = generate_collections.main(args)
+    elapsed = time.time() - start
+
+    import resource
+    print(json.dumps({"ok": ok,
+                      "import_time": import_time,
+                      "time": elapsed,
+                      "maxrss_kb": resource.getrusage(
+                          resource.RUSAGE_SELF).ru_maxrss}))
+
+
+# -------- Parent: generates libraries, runs every mode, compares
+def prepare_library(work_dir, books):
+    sys.path.insert(0, TOOLS_DIR)
+    from make_synthetic_library import make_library
+
+    folder = os.path.join(work_dir, "library-%d" % books)
+    paths_file = os.path.join(folder, "paths.json")
+    if os.path.exists(paths_file):
+        with open(paths_file, "r") as f:
+            return json.load(f)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    paths = make_library(folder, books)
+    with open(paths_file, "w") as f:
+        json.dump(paths, f)
+    return paths
+
+
+def run_mode(python, work_dir, library, mode, change_url, profile=False,
+             max_memory=None):
+    run_dir = os.path.join(work_dir, "run")
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+    # everything a run could modify is a fresh copy
+    config = {"mode": mode,
+              "run_dir": run_dir,
+              "cc_db": os.path.join(run_dir, "cc.db"),
+              "documents": library["documents"],
+              "librarian_json": library["librarian_json"],
+              "calibre_plugin_json": os.path.join(run_dir,
+                                                  "calibre_collections.json"),
+              "export": os.path.join(run_dir, "exported_collections.json"),
+              "folders_snapshot": os.path.join(run_dir,
+                                               "folders_snapshot.json"),
+              "change_url": change_url,
+              "prettyversion": os.path.join(run_dir, "prettyversion.txt"),
+              "session_token": os.path.join(run_dir, "session_token"),
+              "unmatched_summary": os.path.join(run_dir, "unmatched.txt"),
+              "profile_report": None,
+              "max_memory": max_memory}
+    if profile and mode != "startup":
+        config["profile_report"] = os.path.join(
+            work_dir, "profile-%s%s.json" % (
+                os.path.basename(os.path.dirname(library["cc_db"])), mode))
+    shutil.copy(library["cc_db"], config["cc_db"])
+    shutil.copy(library["calibre_plugin_json"],
+                config["calibre_plugin_json"])
+    with open(config["prettyversion"], "w") as f:
+        f.write(PRETTYVERSION)
+
+    output = subprocess.check_output([python, os.path.abspath(__file__),
+                                      "--child", json.dumps(config)])
+    # the result is the last line, whatever LibrarianSync printed before
+    return json.loads(output.decode("utf8").strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, modes in results.items():
+        for mode, result in modes.items():
+            reference = baseline.get(size, {}).get(mode)
+            if reference is None:
+                continue
+            if result["time"] > reference["time"] * (1 + tolerance) and \
+               result["time"] - reference["time"] > MIN_TIME_DELTA:
+                regressions.append("%s books, %s: %.02fs -> %.02fs" % (
+                    size, mode, reference["time"], result["time"]))
+            if result["maxrss_kb"] > reference["maxrss_kb"] * (1 + tolerance)\
+               and result["maxrss_kb"] - reference["maxrss_kb"] > \
+                    MIN_RSS_DELTA_KB:
+                regressions.append("%s books, %s: %dKB -> %dKB peak RSS" % (
+                    size, mode, reference["maxrss_kb"], result["maxrss_kb"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LibrarianSync "
+                                     "on synthetic libraries.")
+    parser.add_argument("--sizes", default=",".join(str(s) for s in SIZES),
+                        help="comma separated numbers of books.")
+    parser.add_argument("--modes", default=",".join(MODES),
+                        help="comma separated generate_collections.py modes.")
+    parser.add_argument("--work-dir", default=None,
+                        help="where libraries are generated (and kept, "
+                        "to be reused by later runs).")
+    parser.add_argument("--python", default=sys.executable,
+                        help="interpreter LibrarianSync runs with.")
+    parser.add_argument("--repeat", type=int, default=1,
+                        help="runs per mode, the fastest one is kept.")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true",
+                        default=False,
+                        help="save the results as the new baseline.")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown/growth over the baseline.")
+    parser.add_argument("--output", default=None,
+                        help="also save the results there.")
+    parser.add_argument("--profile", action="store_true", default=False,
+                        help="run LibrarianSync with --profile, and keep "
+                        "its reports in the work folder.")
+    parser.add_argument("--max-rss", type=int, default=None, metavar="MB",
+                        help="run LibrarianSync with that memory ceiling "
+                        "(--max-memory), and fail if any mode goes over it.")
+    parser.add_argument("--child", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(json.loads(args.child))
+        return 0
+
+    from fake_cc_service import start_service
+
+    work_dir = args.work_dir or os.path.join(tempfile.gettempdir(),
+                                             "librariansync-benchmark")
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    service = start_service(port=0)
+    change_url = "http://127.0.0.1:%d/change" % service.server_address[1]
+
+    results = {}
+    try:
+        for size in [int(s) for s in args.sizes.split(",")]:
+            print("Generating a %d books library..." % size)
+            library = prepare_library(work_dir, size)
+            results[str(size)] = {}
+            for mode in args.modes.split(","):
+                runs = [run_mode(args.python, work_dir, library, mode,
+                                 change_url, args.profile, args.max_rss)
+                        for _ in range(args.repeat)]
+                best = min(runs, key=lambda r: r["time"])
+                best["maxrss_kb"] = max(r["maxrss_kb"] for r in runs)
+                results[str(size)][mode] = best
+                print("%7d books %-18s %7.02fs %8dKB%s" % (
+                    size, mode, best["time"], best["maxrss_kb"],
+                    "" if best["ok"] else "  FAILED"))
+    finally:
+        service.shutdown()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    status = 0
+    if any(not r["ok"] for modes in results.values()
+           for r in modes.values()):
+        status = 1
+    if args.max_rss:
+        for size, modes in sorted(results.items()):
+            for mode, result in sorted(modes.items()):
+                if result["maxrss_kb"] > args.max_rss * 1024:
+                    print("OVER %dMB: %s books, %s: %dKB peak RSS" % (
+                        args.max_rss, size, mode, result["maxrss_kb"]))
+                    status = 1
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Saved baseline to %s" % args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression)
+        if regressions:
+            status = 1
+        else:
+            print("No regression against %s" % args.baseline)
+    return status
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, TOOLS_DIR)
+    sys.exit(main())
@@ -32,7 +32,9 @@ tar -zcvf librariansync.tar.gz \
     librariansync/config.xml \
     librariansync/kindle_contents.py \
     librariansync/kindle_logging.py \
-    librariansync/cc_update.py
+    librariansync/cc_update.py \
+    librariansync/profiling.py \
+    librariansync/watcher.py
 
 # patch config.xml
 # not exactly the most elegant way to do this.
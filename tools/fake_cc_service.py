@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This script is a local stand-in for the Kindle's content catalog service
+(the one LibrarianSync sends its ChangeRequests to, on 127.0.0.1:9101/change),
+so that LibrarianSync can be run and tested off-device.
+
+Every ChangeRequest is acknowledged and counted. If a cc.db is given, the
+commands are applied to it, so that a following run sees their result.
+Latency and random failures can be simulated.
+"""
+
+import argparse
+import json
+import random
+import sqlite3
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+def apply_commands(db_path, commands):
+    with sqlite3.connect(db_path) as db:
+        for command in commands:
+            action, args = list(command.items())[0]
+            if action == "delete":
+                db.execute("delete from Entries where p_uuid = ?",
+                           (args["uuid"],))
+                db.execute("delete from Collections "
+                           "where i_collection_uuid = ?", (args["uuid"],))
+            elif action == "insert":
+                db.execute("insert into Entries (p_uuid, p_type, "
+                           "p_titles_0_nominal) values (?, ?, ?)",
+                           (args["uuid"], args["type"],
+                            args["titles"][0]["display"]))
+            elif action == "update" and args["type"] == "Collection":
+                db.execute("delete from Collections "
+                           "where i_collection_uuid = ?", (args["uuid"],))
+                db.executemany("insert into Collections "
+                               "(i_collection_uuid, i_member_uuid) "
+                               "values (?, ?)",
+                               [(args["uuid"], member)
+                                for member in args["members"]])
+            elif action == "update":
+                db.execute("update Entries set p_collectionCount = ? "
+                           "where p_uuid = ?",
+                           (args["collectionCount"], args["uuid"]))
+
+
+class FakeCCService(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, db_path=None, latency=0.0, fail_rate=0.0):
+        HTTPServer.__init__(self, address, ChangeRequestHandler)
+        self.db_path = db_path
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.commands = 0
+        self.payload_bytes = 0
+
+    def stats(self):
+        return {"requests": self.requests, "failures": self.failures,
+                "commands": self.commands, "payload_bytes": self.payload_bytes}
+
+
+class ChangeRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        if self.path != "/change":
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("content-length", 0)))
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            server.payload_bytes += len(body)
+            if random.random() < server.fail_rate:
+                server.failures += 1
+                self.send_error(500)
+                return
+            try:
+                change = json.loads(body.decode("utf8"))
+                commands = change["commands"]
+                if server.db_path:
+                    apply_commands(server.db_path, commands)
+            except (ValueError, KeyError, sqlite3.Error) as e:
+                server.failures += 1
+                self.send_error(400, str(e))
+                return
+            server.commands += len(commands)
+        answer = json.dumps({"id": change.get("id"), "status": "ok"})
+        self.send_response(200)
+        self.send_header("content-type", "application/json")
+        self.send_header("content-length", str(len(answer)))
+        self.end_headers()
+        self.wfile.write(answer.encode("utf8"))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_service(port=9101, db_path=None, latency=0.0, fail_rate=0.0):
+    """Serve in a background thread, returns the server (.shutdown() it)."""
+    server = FakeCCService(("127.0.0.1", port), db_path, latency, fail_rate)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Kindle content "
+                                     "catalog service, for LibrarianSync.")
+    parser.add_argument("--port", type=int, default=9101)
+    parser.add_argument("--db", default=None,
+                        help="cc.db the commands are applied to.")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="seconds to wait before answering.")
+    parser.add_argument("--fail-rate", type=float, default=0.0,
+                        help="fraction of requests answered with a 500.")
+    args = parser.parse_args()
+
+    server = FakeCCService(("127.0.0.1", args.port), args.db, args.latency,
+                           args.fail_rate)
+    print("Listening on 127.0.0.1:%d..." % args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(server.stats()))
+    sys.stdout.flush()
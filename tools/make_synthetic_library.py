@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This script generates a synthetic Kindle library, to run LibrarianSync
+against off-device. In the given folder, it creates:
+- cc.db: a minimal version of /var/local/cc.db (Entries & Collections
+  tables), with user ebooks, non-user items (periodicals, samples...), and
+  existing collections;
+- documents/: the matching documents tree (empty files), which is also the
+  root all the ebook locations in cc.db point to;
+- collections.json: librarian-style tags for these ebooks, including a few
+  "re:" rules;
+- calibre_collections.json: the same kind of thing, in the format of the
+  Calibre Kindle Collections plugin.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sqlite3
+
+CREATE_ENTRIES = ("create table Entries (p_uuid text primary key, "
+                  "p_type text, p_location text, p_cdeKey text, "
+                  "p_cdeType text, p_titles_0_nominal text, "
+                  "p_collectionCount integer)")
+CREATE_COLLECTIONS = ("create table Collections (i_collection_uuid text, "
+                      "i_member_uuid text)")
+EXTENSIONS = [".azw3", ".mobi", ".epub", ".pdf", ".azw", ".kfx"]
+LOCALE = "en_US"
+
+
+def make_ebooks(books, root, rng):
+    ebooks = []
+    for i in range(books):
+        author = "Author %d" % (i % max(1, books // 20))
+        relative_path = os.path.join("library", author, "Book %d%s" % (
+            i, EXTENSIONS[i % len(EXTENSIONS)]))
+        if i % 3 == 0:
+            # Sideloaded: no ASIN, the cdeKey is a hash of the path
+            cdekey = "*" + hashlib.sha1(
+                relative_path.encode("utf8")).hexdigest()
+            cdetype = "PDOC"
+        else:
+            cdekey = "B%09d" % i
+            cdetype = "EBOK"
+        ebooks.append({"uuid": "%08x-0000-4000-8000-%012x" % (i, i),
+                       "relative_path": relative_path,
+                       "location": os.path.join(root, relative_path),
+                       "cdekey": cdekey,
+                       "cdetype": cdetype,
+                       "labels": []})
+    return ebooks
+
+
+def make_cc_db(db_path, ebooks, labels, other_items, rng):
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    with sqlite3.connect(db_path) as db:
+        db.execute(CREATE_ENTRIES)
+        db.execute(CREATE_COLLECTIONS)
+        db.executemany("insert into Entries values (?, ?, ?, ?, ?, ?, ?)",
+                       [(e["uuid"], "Entry:Item", e["location"], e["cdekey"],
+                         e["cdetype"], e["relative_path"], len(e["labels"]))
+                        for e in ebooks])
+        # periodicals, samples, dictionaries, ...
+        db.executemany("insert into Entries values (?, ?, ?, ?, ?, ?, ?)",
+                       [("item-%d" % i, "Entry:Item",
+                         "/mnt/us/system/.assets/item%d.azw" % i,
+                         "B1%08d" % i, "PDOC", "Item %d" % i, 0)
+                        for i in range(other_items)])
+        collection_uuids = {}
+        for (i, label) in enumerate(labels):
+            collection_uuids[label] = "c011ec70-0000-4000-8000-%012x" % i
+            db.execute("insert into Entries (p_uuid, p_type, "
+                       "p_titles_0_nominal) values (?, ?, ?)",
+                       (collection_uuids[label], "Collection", label))
+        db.executemany("insert into Collections values (?, ?)",
+                       [(collection_uuids[label], e["uuid"])
+                        for e in ebooks for label in e["labels"]])
+        # dangling memberships, of items that aren't user ebooks
+        db.executemany("insert into Collections values (?, ?)",
+                       [(collection_uuids[rng.choice(labels)], "item-%d" % i)
+                        for i in range(0, other_items, 10)])
+
+
+def make_documents_tree(root, ebooks):
+    for e in ebooks:
+        path = e["location"]
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        open(path, "w").close()
+
+
+def make_librarian_json(path, ebooks, labels, changes, rng):
+    tags = {}
+    for e in ebooks:
+        if e["labels"]:
+            e_labels = list(e["labels"])
+            if rng.random() < changes:
+                e_labels = [rng.choice(labels)]
+            tags[e["relative_path"]] = e_labels
+    for i in range(max(1, len(labels) // 10)):
+        tags["re:Author %d/" % i] = ["Regex %d" % i]
+    with open(path, "w") as f:
+        json.dump(tags, f, indent=2, ensure_ascii=False)
+
+
+def make_calibre_plugin_json(path, ebooks, changes, rng):
+    collections = {}
+    for e in ebooks:
+        for label in e["labels"]:
+            if rng.random() < changes:
+                label = "Calibre %s" % label
+            if e["cdekey"].startswith("*"):
+                item = e["cdekey"]
+            else:
+                item = "#%s^%s" % (e["cdekey"], e["cdetype"])
+            collections.setdefault("%s@%s" % (label, LOCALE), {
+                "items": [], "lastAccess": 0})["items"].append(item)
+    with open(path, "w") as f:
+        json.dump(collections, f, indent=2, ensure_ascii=False)
+
+
+def make_library(folder, books, collections=None, other_items=None,
+                 memberships=2, changes=0.1, seed=0):
+    """Generate everything in folder, returns the paths of what was made."""
+    rng = random.Random(seed)
+    if collections is None:
+        collections = max(1, books // 50)
+    if other_items is None:
+        other_items = books // 2
+    root = os.path.join(os.path.abspath(folder), "documents") + os.sep
+    labels = ["Collection %d" % i for i in range(collections)]
+
+    ebooks = make_ebooks(books, root, rng)
+    for e in ebooks:
+        e["labels"] = rng.sample(labels, rng.randint(0, min(memberships,
+                                                             collections)))
+    paths = {"cc_db": os.path.join(folder, "cc.db"),
+             "documents": root,
+             "librarian_json": os.path.join(folder, "collections.json"),
+             "calibre_plugin_json": os.path.join(folder,
+                                                 "calibre_collections.json")}
+    make_cc_db(paths["cc_db"], ebooks, labels, other_items, rng)
+    make_documents_tree(root, ebooks)
+    make_librarian_json(paths["librarian_json"], ebooks, labels, changes, rng)
+    make_calibre_plugin_json(paths["calibre_plugin_json"], ebooks, changes,
+                             rng)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic "
+                                     "Kindle library for LibrarianSync.")
+    parser.add_argument("folder")
+    parser.add_argument("--books", type=int, default=1000)
+    parser.add_argument("--collections", type=int, default=None,
+                        help="defaults to one per 50 books.")
+    parser.add_argument("--other-items", type=int, default=None,
+                        help="non-user items, defaults to half the books.")
+    parser.add_argument("--memberships", type=int, default=2,
+                        help="max. number of collections per book.")
+    parser.add_argument("--changes", type=float, default=0.1,
+                        help="fraction of books whose collections differ "
+                        "between cc.db and the json files.")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.folder):
+        os.makedirs(args.folder)
+    print(json.dumps(make_library(args.folder, args.books, args.collections,
+                                  args.other_items, args.memberships,
+                                  args.changes, args.seed),
+                     indent=2))
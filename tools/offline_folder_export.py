@@ -6,58 +6,157 @@ This script can generate a collections.json file compatible with LibrarianSync.
 It detects the folder structure relative to the path given as argument, and
 associates to any supported ebook a collection named after this relative
 path.
+
+Several folders can be given: they are then merged, as if they were copied
+to the same documents folder.
+Folders are listed by a pool of threads (listing a folder mostly means
+waiting for the disk, or the NAS), and the json file is written as folders
+are listed, rather than built in memory first.
 """
 
-import os
+import argparse
+import fnmatch
 import json
-import codecs
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+SUPPORTED_EXTENSIONS = frozenset([".azw",
+                                  ".mobi",
+                                  ".prc",
+                                  ".pobi",
+                                  ".azw3",
+                                  ".azw6",
+                                  ".yj",
+                                  ".azw1",
+                                  ".tpz",
+                                  ".pdf",
+                                  ".txt",
+                                  ".html",
+                                  ".htm",
+                                  ".jpg",
+                                  ".jpeg",
+                                  ".azw2",
+                                  ".kfx",
+                                  ".epub"])
+
+# folders that are never looked into (hidden folders, Kindle sidecars, and
+# what NAS/OSes leave lying around), case insensitive
+IGNORED_FOLDERS = [".*",
+                   "*.sdr",
+                   "@eadir",
+                   "#recycle",
+                   "#snapshot",
+                   "$recycle.bin",
+                   "system volume information",
+                   "__macosx"]
+# folders listed in parallel
+JOBS = 16
+
+
+def list_directory(path, ignored):
+    files = []
+    subdirs = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                name = entry.name.lower()
+                if not any(fnmatch.fnmatchcase(name, pattern)
+                           for pattern in ignored):
+                    subdirs.append(entry.name)
+            elif os.path.splitext(entry.name.lower())[1] in \
+                    SUPPORTED_EXTENSIONS:
+                files.append(entry.name)
+    return files, subdirs
 
-SUPPORTED_EXTENSIONS = [".azw",
-                        ".mobi",
-                        ".prc",
-                        ".pobi",
-                        ".azw3",
-                        ".azw6",
-                        ".yj",
-                        ".azw1",
-                        ".tpz",
-                        ".pdf",
-                        ".txt",
-                        ".html",
-                        ".htm",
-                        ".jpg",
-                        ".jpeg",
-                        ".azw2",
-                        ".kfx",
-                        ".epub"]
-
-
-def list_folder_contents():
-    folder_contents = {}
-    for root, dirs, files in os.walk(EBOOKS_ROOT):
-        for f in [get_relative_path(os.path.join(root, el))
-                  for el in files
-                  if os.path.splitext(el.lower())[1] in SUPPORTED_EXTENSIONS]:
-            if get_relative_path(root) != u"":
-                folder_contents[f] = [get_relative_path(root)]
-    return folder_contents
-
-
-def get_relative_path(path):
-    return path.split(EBOOKS_ROOT)[1]
+
+def list_merged_directory(roots, relative_dir, ignored):
+    files = set()
+    subdirs = set()
+    for root in roots:
+        path = os.path.join(root, *relative_dir.split("/")) if relative_dir \
+            else root
+        try:
+            root_files, root_subdirs = list_directory(path, ignored)
+        except FileNotFoundError:
+            # only in some of the roots
+            continue
+        except OSError as e:
+            print("Skipping %s: %s" % (path, e), file=sys.stderr)
+            continue
+        files.update(root_files)
+        subdirs.update(root_subdirs)
+    return sorted(files), sorted(subdirs)
+
+
+def list_folder_contents(roots, jobs=JOBS, ignored=IGNORED_FOLDERS):
+    """Yields (ebook path, collection), folder by folder, in a stable order.
+    Subfolders are queued as soon as their parent is listed, so the pool
+    stays busy however far behind the writing is."""
+    ignored = [pattern.lower() for pattern in ignored]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        def list_and_queue(relative_dir):
+            files, subdirs = list_merged_directory(roots, relative_dir,
+                                                   ignored)
+            # (relative dir, future), in the order they're written
+            children = []
+            for d in subdirs:
+                child = relative_dir + "/" + d if relative_dir else d
+                children.append((child,
+                                 executor.submit(list_and_queue, child)))
+            return files, children
+
+        pending = [("", executor.submit(list_and_queue, ""))]
+        while pending:
+            relative_dir, future = pending.pop()
+            files, children = future.result()
+            pending.extend(reversed(children))
+            # ebooks directly in the documents folder are ignored
+            if relative_dir:
+                for f in files:
+                    yield relative_dir + "/" + f, relative_dir
+
+
+def write_collections(output_file, contents):
+    """Writes what json.dumps(indent=2, ensure_ascii=False) would, one entry
+    at a time. Returns the number of entries."""
+    tmp_file = output_file + ".tmp"
+    number_of_entries = 0
+    with open(tmp_file, "w", encoding="utf8") as export_json:
+        for path, collection in contents:
+            export_json.write(",\n" if number_of_entries else "{\n")
+            export_json.write('  %s: [\n    %s\n  ]' % (
+                json.dumps(path, ensure_ascii=False),
+                json.dumps(collection, ensure_ascii=False)))
+            number_of_entries += 1
+        export_json.write("\n}" if number_of_entries else "{}")
+    os.replace(tmp_file, output_file)
+    return number_of_entries
 
 
 if __name__ == "__main__":
-    try:
-        assert len(sys.argv) == 2
-        EBOOKS_ROOT = sys.argv[1]
-        assert os.path.exists(EBOOKS_ROOT)
-    except:
-        print("Script must have a valid folder as argument.")
-    else:
-        js = json.dumps(list_folder_contents(), sort_keys=True, indent=2,
-                        separators=(',', ': '), ensure_ascii=False)
-
-        with codecs.open("collections.json", "w", "utf8") as export_json:
-            export_json.write(js)
+    parser = argparse.ArgumentParser(
+        description="Generate a LibrarianSync collections.json from the "
+        "folder structure of one or more ebook folders.")
+    parser.add_argument("roots", nargs="+", metavar="folder",
+                        help="folder(s) to scan, standing for the Kindle "
+                        "documents folder.")
+    parser.add_argument("-o", "--output", default="collections.json",
+                        help="json file to write (default: %(default)s).")
+    parser.add_argument("-j", "--jobs", type=int, default=JOBS,
+                        help="folders listed in parallel "
+                        "(default: %(default)s).")
+    parser.add_argument("--ignore", action="append", default=[],
+                        metavar="PATTERN",
+                        help="also skip folders matching this pattern "
+                        "(e.g. 'drafts*'), on top of: %s." %
+                        ", ".join(IGNORED_FOLDERS))
+    args = parser.parse_args()
+
+    for root in args.roots:
+        if not os.path.isdir(root):
+            parser.error("%s is not a folder." % root)
+    number_of_entries = write_collections(
+        args.output, list_folder_contents(args.roots, max(1, args.jobs),
+                                          IGNORED_FOLDERS + args.ignore))
+    print("%d ebooks written to %s." % (number_of_entries, args.output))